@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# coding: utf-8
+# @Time : 2026/10/18 17:30
+# @Author : yangpingyan@gmail.com
+
+# 性能测试, 每个cell单独运行, 结果打印到终端
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.pool import NullPool, QueuePool
+from sql import SqlConnection, sql_pool_options
+
+
+def latency_summary(latencies):
+    '''延迟列表(秒)的p50/p99/max, 单位毫秒'''
+    latencies = np.array(latencies) * 1000
+    return "p50 {:.2f}ms p99 {:.2f}ms max {:.2f}ms".format(np.percentile(latencies, 50),
+                                                          np.percentile(latencies, 99), latencies.max())
+
+
+def run_load(func, args, workers):
+    '''用workers个线程并发调用func(arg), 返回每次调用的延迟和总耗时'''
+
+    def timed(arg):
+        start = time.perf_counter()
+        func(arg)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        latencies = list(pool.map(timed, args))
+    return latencies, time.perf_counter() - start
+
+
+# In[]
+# 连接池: 本地sqlite库代替MySQL, 比较连接池与每次查询新建连接(NullPool)在并发查询下的延迟
+db_path = os.path.join(tempfile.mkdtemp(), 'mibao_benchmark.db')
+sqlite_options = {'connect_args': {'check_same_thread': False}}
+setup = SqlConnection(url='sqlite:///' + db_path, pool_options=dict(sqlite_options, poolclass=NullPool))
+pd.DataFrame({'id': np.arange(100000), 'user_id': np.random.randint(0, 20000, 100000),
+              'pay_num': np.random.rand(100000)}).to_sql('order', setup.engine, index=False)
+with setup.engine.begin() as conn:
+    conn.exec_driver_sql("CREATE INDEX order_id ON `order` (id)")
+setup.close()
+
+order_ids = np.random.randint(0, 100000, 5000).tolist()
+for name, options in [('pool', dict(sqlite_options, poolclass=QueuePool, **sql_pool_options)),
+                      ('no pool', dict(sqlite_options, poolclass=NullPool))]:
+    connection = SqlConnection(url='sqlite:///' + db_path, pool_options=options)
+    query = lambda order_id: connection.execute(
+        lambda engine: pd.read_sql_query("SELECT * FROM `order` o WHERE o.id = {};".format(order_id), engine))
+    for workers in [1, 8, 32]:
+        latencies, total = run_load(query, order_ids, workers)
+        print("{:8s} workers {:3d}: {:7.0f} qps, {}".format(name, workers, len(order_ids) / total,
+                                                            latency_summary(latencies)))
+    print("{} stats: {}".format(name, connection.pool_stats()))
+    connection.close()
+
+
+# In[]
+# gevent服务的并发: 模拟20ms数据库查询和2ms CPU计算的接口, 比较直接执行与交给线程池(Offloader)执行时
+# 吞吐量随同时请求数的变化。直接执行时数据库查询阻塞整个进程, 吞吐量不随并发增加
+import multiprocessing
+import urllib.request
+
+
+def serve_standin(port, offload, io_seconds=0.02, cpu_seconds=0.002):
+    from flask import Flask
+    from gevent.pywsgi import WSGIServer
+    from mibao_concurrency import Offloader
+
+    app = Flask(__name__)
+    standin_offloader = Offloader()
+
+    def score(order_id):
+        time.sleep(io_seconds)
+        with standin_offloader.cpu_bound():
+            end = time.perf_counter() + cpu_seconds
+            while time.perf_counter() < end:
+                pass
+        return order_id
+
+    @app.route('/ml_result/<int:order_id>', methods=['GET'])
+    def get_result(order_id):
+        return str(standin_offloader.run(score, order_id))
+
+    if offload:
+        standin_offloader.start()
+    WSGIServer(('127.0.0.1', port), app, log=None).serve_forever()
+
+
+def wait_server(url, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return urllib.request.urlopen(url).read()
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+for name, offload in [('inline', False), ('offload', True)]:
+    port = 5100 + offload
+    server = multiprocessing.Process(target=serve_standin, args=(port, offload), daemon=True)
+    server.start()
+    wait_server('http://127.0.0.1:{}/ml_result/0'.format(port))
+    url = 'http://127.0.0.1:{}/ml_result/{{}}'.format(port)
+    request = lambda order_id: urllib.request.urlopen(url.format(order_id)).read()
+    for in_flight in [1, 4, 16, 64]:
+        latencies, total = run_load(request, range(400), in_flight)
+        print("{:8s} in-flight {:3d}: {:6.0f} req/s, {}".format(name, in_flight, 400 / total,
+                                                               latency_summary(latencies)))
+    server.terminate()
+
+
+# In[]
+# 多进程服务: 每个请求10ms CPU计算的接口, 比较不同工作进程数的吞吐量, 进程数不超过CPU核数时应近似线性增加
+import signal
+from mibao_concurrency import serve_prefork
+
+
+def serve_cpu_standin(port, workers, cpu_seconds=0.01):
+    from flask import Flask
+
+    app = Flask(__name__)
+
+    @app.route('/ml_result/<int:order_id>', methods=['GET'])
+    def get_result(order_id):
+        end = time.process_time() + cpu_seconds
+        while time.process_time() < end:
+            pass
+        return str(order_id)
+
+    serve_prefork(app, port, workers)
+
+
+print("cpu count: {}".format(os.cpu_count()))
+for workers in sorted(set([1, 2, 4, os.cpu_count()])):
+    port = 5200 + workers
+    server = multiprocessing.Process(target=serve_cpu_standin, args=(port, workers))
+    server.start()
+    wait_server('http://127.0.0.1:{}/ml_result/0'.format(port))
+    url = 'http://127.0.0.1:{}/ml_result/{{}}'.format(port)
+    request = lambda order_id: urllib.request.urlopen(url.format(order_id)).read()
+    latencies, total = run_load(request, range(1000), 32)
+    print("workers {:3d}: {:6.0f} req/s, {}".format(workers, 1000 / total, latency_summary(latencies)))
+    os.kill(server.pid, signal.SIGTERM)
+    server.join()
+
+
+# In[]
+# 微批预测: 用随机数据训练一个与线上特征数相同的模型, 比较并发单行预测直接执行与合并成批执行的吞吐量和延迟
+from mibao_model import MibaoModel, train_model_bundle
+from mibao_concurrency import MicroBatcher
+from mldata import mibao_ml_features
+
+x = np.random.rand(5000, len(mibao_ml_features))
+train_df = pd.DataFrame(x, columns=mibao_ml_features)
+train_df['target'] = (x[:, 0] + x[:, 1] + np.random.rand(5000) * 0.2 > 1.1).astype(int)
+model = MibaoModel(train_model_bundle(train_df, mibao_ml_features, {}, {'n_estimators': 300, 'verbose': -1}))
+rows = [x[i:i + 1] for i in range(3000)]
+
+for name, max_wait in [('direct', 0), ('batch 1ms', 0.001), ('batch 2ms', 0.002), ('batch 5ms', 0.005)]:
+    if max_wait == 0:
+        predict = lambda row: int(model.predict_values(row)[0] > 0.5)
+    else:
+        batcher = MicroBatcher(lambda items: list(model.predict_values(np.vstack(items)) > 0.5), 32, max_wait)
+        predict = batcher.submit
+    for workers in [1, 16, 64]:
+        latencies, total = run_load(predict, rows, workers)
+        print("{:10s} threads {:3d}: {:6.0f} rows/s, {}".format(name, workers, len(rows) / total,
+                                                                latency_summary(latencies)))
+
+
+# In[]
+# 单个订单的特征处理: 用datasets目录中保存的订单数据, 比较process_data_mibao整表处理与process_order_features
+# 逐行计算每个订单的耗时
+from mldata import get_orders_data, process_data_mibao, process_order_features
+
+corpus_df = get_orders_data([], is_sql=False)  # 从文件读取时返回所有订单
+# 从文件读取时手机号为数值类型, 还原为与数据库读取相同的字符串, 否则单个订单无法使用str方法
+for feature in ['phone', 'phone_user']:
+    corpus_df[feature] = corpus_df[feature].map(lambda x: '{:.0f}'.format(x) if isinstance(x, float) and x == x else x)
+order_dfs = [df.reset_index(drop=True) for _, df in corpus_df.groupby('order_id', sort=False)]
+order_dfs = [df for df in order_dfs if process_order_features(df) is not None][:2000]
+for name, process in [('process_data_mibao', lambda df: process_data_mibao(df.copy())[mibao_ml_features].values),
+                      ('process_order_features', process_order_features)]:
+    latencies, total = run_load(process, order_dfs, 1)
+    print("{:24s}: {:8.1f} us/order, {}".format(name, total / len(order_dfs) * 1e6, latency_summary(latencies)))
+
+
+# In[]
+# 全量重建的特征处理: datasets目录中的订单合并后重复到10万行以上, 测试process_data_mibao整表处理的耗时
+history_df = pd.concat([corpus_df] * int(np.ceil(100000 / len(corpus_df))), ignore_index=True)
+for repeat in range(3):
+    start = time.perf_counter()
+    process_data_mibao(history_df.copy())
+    elapsed = time.perf_counter() - start
+    print("process_data_mibao {} rows: {:.2f}s, {:.0f} rows/s".format(len(history_df), elapsed,
+                                                                    len(history_df) / elapsed))
+
+
+# In[]
+# json列的解析: datasets目录中的order_detail和order_phone_book重复到10万行以上, 比较json模块、默认解析方式(安装了orjson时使用)
+# 及逐个解析数组元素(通讯录)的耗时; 最大的通讯录比较整个解析与逐个解析联系人的内存峰值
+import json
+import tracemalloc
+from mibao_json import json_loads, iter_json_array, orjson
+from mldata import order_detail_json, phone_book_json, read_mlfile, order_detail_features, order_phone_book_features
+from mldata import count_name_nums
+
+print("orjson: {}".format(orjson is not None))
+for table, features, column, json_column in [('order_detail', order_detail_features, 'order_detail', order_detail_json),
+                                             ('order_phone_book', order_phone_book_features, 'phone_book',
+                                              phone_book_json)]:
+    values = read_mlfile(table, features)[column].tolist()
+    # 相同的json字符串只解析一次, 每份复制的数据加上不同数量的空格, 使复制的值也要解析
+    values = [x + ' ' * copy if isinstance(x, str) else x
+              for copy in range(int(np.ceil(100000 / len(values)))) for x in values]
+    loads = json_column.loads
+    for name, json_column.loads in [('json', json.loads), ('default', json_loads), ('stream', iter_json_array)]:
+        if column == 'order_detail' and name == 'stream':
+            continue
+        start = time.perf_counter()
+        json_column.extract(values)
+        print("{:12s} {:8s} {} rows: {:.2f}s".format(column, name, len(values), time.perf_counter() - start))
+    json_column.loads = loads
+
+phone_book = max([x for x in values if isinstance(x, str)], key=len)
+for name, loads in [('json', json.loads), ('stream', iter_json_array)]:
+    tracemalloc.start()
+    count_name_nums(loads(phone_book))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("largest phone_book {} bytes, {:8s} peak memory {:.2f}MB".format(len(phone_book), name, peak / 1e6))
+
+
+# In[]
+# 大表导出: 本地sqlite库中5万行约2KB的json, 比较整表读入DataFrame再写csv与export_table分块写csv的耗时和内存峰值
+import json
+import tracemalloc
+from mibao_export import ExportState, export_table
+
+export_dir = tempfile.mkdtemp()
+export_connection = SqlConnection(url='sqlite:///' + os.path.join(export_dir, 'export.db'),
+                                  pool_options={'poolclass': NullPool})
+phone_book = json.dumps([{'name': 'name{}'.format(i), 'phone': '1380000{:04d}'.format(i)} for i in range(50)])
+pd.DataFrame({'id': np.arange(50000), 'order_id': np.arange(50000), 'phone_book': phone_book}).to_sql(
+    'order_phone_book', export_connection.engine, index=False)
+
+
+def export_whole(path):
+    df = export_connection.execute(
+        lambda engine: pd.read_sql_query("SELECT order_id,phone_book,id FROM `order_phone_book`;", engine))
+    df.to_csv(path, index=False)
+
+
+def export_chunked(path):
+    export_table(export_connection, 'order_phone_book', ['order_id', 'phone_book'], path,
+                 ExportState(os.path.join(export_dir, 'export_state.json')), incremental=False)
+
+
+for name, export in [('whole', export_whole), ('chunked', export_chunked)]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    export(os.path.join(export_dir, name + '.csv'))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("{:8s} {:.2f}s, peak memory {:.1f}MB".format(name, elapsed, peak / 1e6))
+export_connection.close()
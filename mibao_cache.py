@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding: utf-8
+# @Time : 2026/10/18 16:40
+# @Author : yangpingyan@gmail.com
+
+import time
+import threading
+from collections import OrderedDict
+
+_missing = object()
+
+
+class TTLCache(object):
+    '''线程安全的LRU缓存
+
+    条目超过ttl秒失效, 条目数超过maxsize时淘汰最久未使用的条目。
+    stats返回命中、未命中、淘汰等计数, 用于/metrics。
+    '''
+
+    def __init__(self, maxsize=10000, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self.lock:
+            item = self.data.get(key, _missing)
+            if item is not _missing and item[0] < now:
+                del self.data[key]
+                self.expirations += 1
+                item = _missing
+            if item is _missing:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        expire_time = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.data[key] = (expire_time, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            return self.data.pop(key, _missing) is not _missing
+
+    def delete_if(self, predicate):
+        '''删除key满足predicate的所有条目, 返回删除的条目数'''
+        with self.lock:
+            keys = [key for key in self.data if predicate(key)]
+            for key in keys:
+                del self.data[key]
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def after_fork(self):
+        '''fork出的子进程中重建锁, fork时其它线程(如模型切换后清空缓存)持有的锁在子进程中不会释放'''
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations}
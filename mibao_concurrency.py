@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# coding: utf-8
+# @Time : 2026/10/18 18:10
+# @Author : yangpingyan@gmail.com
+
+import os
+import gc
+import sys
+import time
+import queue
+import signal
+import socket
+import threading
+from contextlib import contextmanager
+from mibao_log import log
+from mibao_metrics import metrics
+
+
+class Offloader(object):
+    '''在gevent服务中执行阻塞函数
+
+    服务没有monkey patch, pymysql和SSH隧道的socket读写会阻塞整个进程。
+    run把函数交给线程池执行, 调用的协程等待结果时让出, 其它请求继续处理;
+    未start时(如flask自带的服务器)直接在当前线程执行。
+    cpu_bound限制同时进行特征处理、预测等CPU密集计算的线程数, 其余线程排队等待,
+    避免大量线程争抢GIL使所有请求一起变慢。
+    '''
+
+    def __init__(self, io_workers=32, cpu_workers=2):
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.cpu_semaphore = threading.BoundedSemaphore(cpu_workers)
+        self.pool = None
+
+    def start(self, io_workers=None, cpu_workers=None):
+        '''创建gevent线程池, 需在gevent服务启动前调用'''
+        from gevent.threadpool import ThreadPool
+        if io_workers is not None:
+            self.io_workers = io_workers
+        if cpu_workers is not None:
+            self.cpu_workers = cpu_workers
+            self.cpu_semaphore = threading.BoundedSemaphore(cpu_workers)
+        self.pool = ThreadPool(self.io_workers)
+
+    def run(self, func, *args):
+        if self.pool is None:
+            return func(*args)
+        return self.pool.apply(func, args)
+
+    @contextmanager
+    def cpu_bound(self):
+        start = time.perf_counter()
+        with self.cpu_semaphore:
+            metrics.observe('mibao_stage_seconds', time.perf_counter() - start, stage='cpu_wait')
+            yield
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''合并相同key的并发调用
+
+    同一key同时只执行一次func, 执行期间相同key的其它调用等待并使用同一个结果(或异常)。
+    执行结束后不保留结果, 之后的调用重新执行。
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            metrics.inc('mibao_singleflight_coalesced_total', group=self.name)
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        metrics.inc('mibao_singleflight_calls_total', group=self.name)
+        try:
+            call.result = func(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.calls)
+
+
+class MicroBatcher(object):
+    '''把并发的单行预测合并成批量预测
+
+    submit把数据放入队列后等待结果。后台线程取出第一条数据后, 最多再等max_wait秒或凑满max_batch条,
+    用func(数据列表)一次计算, func返回与数据列表一一对应的结果列表, 出现异常时这一批的调用都抛出该异常。
+    多进程服务中每个进程第一次submit时启动自己的后台线程。
+    '''
+
+    def __init__(self, func, max_batch=32, max_wait=0.002, name='predict'):
+        self.func = func
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        self.pid = None
+
+    def submit(self, item):
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items):
+        '''一次提交多条数据, 它们可以进入同一批, 返回对应的结果列表'''
+        if self.pid != os.getpid():
+            self.start()
+        calls = [_Call() for _ in items]
+        for item, call in zip(items, calls):
+            self.queue.put((item, call))
+        results = []
+        for call in calls:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            results.append(call.result)
+        return results
+
+    def start(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue()
+                self.thread = threading.Thread(target=self.run, name='micro_batcher', daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            metrics.inc('mibao_batches_total', group=self.name)
+            metrics.inc('mibao_batch_rows_total', len(batch), group=self.name)
+            try:
+                results = self.func([item for item, _ in batch])
+                for (_, call), result in zip(batch, results):
+                    call.result = result
+            except Exception as e:
+                for _, call in batch:
+                    call.error = e
+            for _, call in batch:
+                call.event.set()
+
+
+# 服务进程共用
+offloader = Offloader()
+
+
+def serve_prefork(app, port=5000, workers=None, after_fork=None, before_exit=None):
+    '''多进程gevent服务
+
+    主进程已加载的模型和数据在fork后按写时复制共享, 不会复制多份; fork前gc.freeze,
+    避免垃圾回收修改这些对象的内存页。所有工作进程共用主进程创建的监听端口。
+    after_fork在工作进程中调用, 重建fork后不存在的后台线程等; before_exit在工作进程退出前调用。
+    工作进程异常退出时主进程重新fork一个, 主进程收到SIGTERM或SIGINT时结束所有工作进程。
+    '''
+    from gevent.pywsgi import WSGIServer
+    workers = workers or os.cpu_count()
+    listener = socket.create_server(('0.0.0.0', port), backlog=1024)
+    # 多个进程同时被新连接唤醒, 没抢到连接的进程accept不能阻塞
+    listener.setblocking(False)
+    gc.freeze()
+
+    def start_worker():
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if after_fork is not None:
+                after_fork()
+            WSGIServer(listener, app).serve_forever()
+        except SystemExit:
+            pass
+        except Exception as e:
+            log.error("worker {} failed: {}".format(os.getpid(), e))
+            code = 1
+        finally:
+            if before_exit is not None:
+                before_exit()
+        os._exit(code)
+
+    pids = set(start_worker() for _ in range(workers))
+    print('listen on 0.0.0.0:{} with {} workers'.format(port, workers))
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while len(pids) > 0:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        pids.discard(pid)
+        if len(stopping) == 0:
+            log.warning("worker {} exited with status {}, restarting".format(pid, status))
+            time.sleep(1)
+            pids.add(start_worker())
+    listener.close()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# coding: utf-8
+# @Time : 2026/10/18 19:05
+# @Author : yangpingyan@gmail.com
+
+import os
+import json
+import shutil
+import time
+import datetime
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text, bindparam
+from mibao_log import log
+
+# 增量导出按主键更新本地csv; 水位字段按顺序取表中存在的第一个, 有update_time时取新增和修改的行, 否则按自增id只取新增的行
+export_key = 'id'
+export_watermark_columns = ['update_time', 'id']
+
+
+class ExportState(object):
+    '''每个表上次导出的记录, 保存在json文件中
+
+    watermark为水位字段, value为已导出行中水位字段的最大值, columns为csv的字段, full_time为上次全量导出的时间
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = {}
+        # 并发导出时多个线程更新
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.tables = json.load(f)
+
+    def get(self, table):
+        return self.tables.get(table)
+
+    def set(self, table, state):
+        with self.lock:
+            self.tables[table] = state
+            # 先写临时文件再替换, 中途退出时已导出的表不用重新导出
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.tables, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+def get_table_columns(connection, table):
+    df = connection.execute(lambda engine: pd.read_sql_query("SELECT * FROM `{}` LIMIT 0;".format(table), engine))
+    return list(df.columns)
+
+
+def json_value(value):
+    '''水位字段或主键的值转为可以保存到json并作为查询参数的python类型, 空值返回None'''
+    if value is None or pd.isna(value):
+        return None
+    if isinstance(value, (pd.Timestamp, datetime.datetime, datetime.date)):
+        return str(value)
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def write_query_csv(connection, statement, params, path, columns, watermark=None, key=None, collect_keys=False,
+                    chunksize=10000, progress_interval=10, name=None):
+    '''用服务器端游标分块读取查询结果, 每块的columns字段直接追加到csv文件, 内存只与chunksize有关
+
+    返回字典: rows为行数, value为水位字段的最大值, boundary_keys为水位等于最大值的行的主键,
+    min_key, max_key为主键的范围, keys为主键(字符串)的集合(collect_keys时)。
+    每隔progress_interval秒打印已读取的行数和速度。连接出错时重新连接后从头重写文件。
+    '''
+    name = name or os.path.basename(path)
+
+    def write(engine):
+        start = last_progress = time.time()
+        result = {'rows': 0, 'value': None, 'boundary_keys': [], 'min_key': None, 'max_key': None,
+                  'keys': set() if collect_keys else None}
+        maximum = None
+        with engine.connect() as conn, open(path, 'w', encoding='utf-8', newline='') as f:
+            # pymysql使用不缓存结果的SSCursor, 逐块从服务器读取
+            conn = conn.execution_options(stream_results=True)
+            pd.DataFrame(columns=columns).to_csv(f, index=False)
+            for chunk in pd.read_sql_query(statement, conn, params=params, chunksize=chunksize):
+                chunk[columns].to_csv(f, header=False, index=False)
+                result['rows'] += len(chunk)
+                if key is not None and len(chunk) > 0:
+                    min_key, max_key = json_value(chunk[key].min()), json_value(chunk[key].max())
+                    if result['min_key'] is None or min_key < result['min_key']:
+                        result['min_key'] = min_key
+                    if result['max_key'] is None or max_key > result['max_key']:
+                        result['max_key'] = max_key
+                    if collect_keys:
+                        result['keys'].update(chunk[key].astype(str))
+                if watermark is not None and chunk[watermark].notna().any():
+                    values = chunk[watermark]
+                    chunk_max = values.max()
+                    boundary_keys = chunk.loc[values == chunk_max, key].tolist() if key is not None else []
+                    if maximum is None or chunk_max > maximum:
+                        maximum, result['boundary_keys'] = chunk_max, boundary_keys
+                    elif chunk_max == maximum:
+                        result['boundary_keys'].extend(boundary_keys)
+                if time.time() - last_progress >= progress_interval:
+                    last_progress = time.time()
+                    log.info("{}: {} rows, {:.1f}MB, {:.0f} rows/s".format(name, result['rows'], f.tell() / 1e6,
+                                                                            result['rows'] / (last_progress - start)))
+            size = f.tell()
+        result['value'] = json_value(maximum)
+        elapsed = time.time() - start
+        log.debug("{}: {} rows, {:.1f}MB in {:.1f}s, {:.0f} rows/s, {:.1f}MB/s".format(
+            name, result['rows'], size / 1e6, elapsed, result['rows'] / max(elapsed, 1e-6),
+            size / 1e6 / max(elapsed, 1e-6)))
+        return result
+
+    return connection.execute(write)
+
+
+def upsert_csv(path, delta_path, key, keys, chunksize=100000):
+    '''用delta_path中的行更新csv文件: 去掉主键在keys中的旧行, 再把delta_path的行追加到文件末尾
+
+    旧行按文本读写, 不改变原来的格式; 分块读取, 内存只与keys和chunksize有关
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        with open(delta_path, encoding='utf-8', newline='') as delta:
+            f.write(delta.readline())
+            for chunk in pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunksize):
+                chunk[~chunk[key].isin(keys)].to_csv(f, header=False, index=False)
+            shutil.copyfileobj(delta, f)
+    os.replace(tmp_path, path)
+    os.remove(delta_path)
+
+
+def append_csv(path, delta_path):
+    '''把delta_path中的行(不含表头)追加到csv文件末尾, 不读取已有的行'''
+    with open(path, 'a', encoding='utf-8', newline='') as f:
+        with open(delta_path, encoding='utf-8', newline='') as delta:
+            delta.readline()
+            shutil.copyfileobj(delta, f)
+    os.remove(delta_path)
+
+
+def export_table(connection, table, features, path, state, incremental=True, full_interval=7 * 24 * 3600,
+                 chunksize=10000, max_boundary_keys=1000):
+    '''把表的features字段导出到csv文件, 返回读取的行数
+
+    incremental时只读取上次导出后新增或修改的行: 水位字段为自增id时取id大于上次最大值的行;
+    为update_time时取大于上次最大值的行, 以及等于上次最大值但上次没有导出的行(同一时刻写入的行)。
+    新的行的主键都大于csv中的主键时直接追加到文件末尾, 否则按主键更新csv文件。
+    没有导出记录、csv文件不存在、字段有变化、表中没有主键或水位字段, 或距上次全量导出超过full_interval秒时全量导出,
+    全量导出去掉数据库中已删除的行, 并补上提交时间晚于水位、修改时间早于水位的行,
+    以及上次导出后在同一时刻再次修改的行。
+    查询结果每次读取chunksize行写入文件, 大表导出时内存不随表的大小增加。
+    '''
+    columns = get_table_columns(connection, table)
+    key = export_key if export_key in columns else None
+    watermark = next((c for c in export_watermark_columns if c in columns), None)
+    # csv中保留主键, 用于之后的增量更新
+    export_columns = list(features) + ([key] if key is not None and key not in features else [])
+    select_columns = export_columns + ([watermark] if watermark is not None and watermark not in export_columns else [])
+    sql = "SELECT {} FROM `{}`".format(",".join(select_columns), table)
+
+    last = state.get(table)
+    full = (not incremental or key is None or watermark is None or last is None or last['value'] is None
+            or last['watermark'] != watermark or last['columns'] != export_columns
+            or time.time() - last['full_time'] > full_interval or not os.path.exists(path))
+    start = time.time()
+    if full:
+        tmp_path = path + '.tmp'
+        result = write_query_csv(connection, text(sql + ";"), None, tmp_path, export_columns, watermark, key,
+                                 chunksize=chunksize, name=table)
+        os.replace(tmp_path, path)
+        boundary_keys, max_key = result['boundary_keys'], result['max_key']
+    else:
+        params = {'watermark': last['value']}
+        if watermark == key:
+            # 自增id不会修改, 只取新增的行
+            statement = text(sql + " WHERE {} > :watermark;".format(watermark))
+        elif last.get('boundary_keys'):
+            statement = text(sql + " WHERE {0} > :watermark OR ({0} = :watermark AND {1} NOT IN :boundary_keys);"
+                             .format(watermark, key)).bindparams(bindparam('boundary_keys', expanding=True))
+            params['boundary_keys'] = last['boundary_keys']
+        else:
+            statement = text(sql + " WHERE {} >= :watermark;".format(watermark))
+        delta_path = path + '.delta'
+        result = write_query_csv(connection, statement, params, delta_path, export_columns, watermark, key,
+                                 collect_keys=True, chunksize=chunksize, name=table)
+        if result['rows'] == 0:
+            os.remove(delta_path)
+        elif last.get('max_key') is not None and result['min_key'] > last['max_key']:
+            append_csv(path, delta_path)
+        else:
+            upsert_csv(path, delta_path, key, result['keys'])
+        if result['value'] is None:
+            result['value'], boundary_keys = last['value'], last.get('boundary_keys')
+        elif result['value'] == last['value']:
+            boundary_keys = (last.get('boundary_keys') or []) + result['boundary_keys']
+        else:
+            boundary_keys = result['boundary_keys']
+        max_key = last.get('max_key')
+        if max_key is None or (result['max_key'] is not None and result['max_key'] > max_key):
+            max_key = result['max_key']
+    if watermark is not None:
+        # 同一时刻写入的行太多(如批量修改)时不再记录, 下次导出重新读取这一时刻的行
+        if boundary_keys is not None and len(boundary_keys) > max_boundary_keys:
+            boundary_keys = None
+        state.set(table, {'watermark': watermark,
+                          'value': result['value'],
+                          'boundary_keys': boundary_keys if watermark != key else None,
+                          'max_key': max_key,
+                          'columns': export_columns,
+                          'full_time': start if full else last['full_time']})
+    rows = result['rows']
+    elapsed = time.time() - start
+    log.info("{} exported {} rows ({}) in {:.1f}s, {:.0f} rows/s".format(table, rows, 'full' if full else 'incremental',
+                                                                          elapsed, rows / max(elapsed, 1e-6)))
+    return rows
+
+
+def export_tables(connection, tables, export_dir, state, workers=4, **options):
+    '''用workers个线程并发导出多个表, tables为(表名, 字段)列表, 返回表名到行数的字典
+
+    每个线程从connection的连接池取自己的连接, workers不能超过连接池的大小。
+    按本地csv文件从大到小开始导出(还没有csv文件的表最先), 总耗时接近最大的表而不是所有表之和。
+    某个表出错时其它表继续导出, 全部结束后抛出第一个异常。options传给export_table。
+    '''
+    paths = {table: os.path.join(export_dir, table + '.csv') for table, _ in tables}
+    ordered = sorted(tables, key=lambda x: -os.path.getsize(paths[x[0]]) if os.path.exists(paths[x[0]])
+                     else -np.inf)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(table, pool.submit(export_table, connection, table, features, paths[table], state, **options))
+                   for table, features in ordered]
+    results = {}
+    errors = []
+    for table, future in futures:
+        try:
+            results[table] = future.result()
+        except Exception as e:
+            log.error("{} export failed: {}".format(table, e))
+            errors.append(e)
+    if len(errors) > 0:
+        raise errors[0]
+    return results
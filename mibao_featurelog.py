@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding: utf-8
+# @Time : 2026/10/18 15:20
+# @Author : yangpingyan@gmail.com
+
+import os
+import time
+import atexit
+import threading
+import numpy as np
+import pandas as pd
+from mibao_log import log
+
+
+class FeatureLog(object):
+    '''在线预测的特征日志
+
+    特征行写入预分配的环形缓冲区, 后台线程在未写出的行数达到flush_rows或每隔flush_interval秒时,
+    把它们按列写入一个npz文件, 文件数超过max_files时删除最早的文件。
+    缓冲区满时覆盖最早未写出的行, 并计入dropped。
+    '''
+
+    def __init__(self, columns, log_dir, capacity=10000, flush_rows=1000, flush_interval=60, max_files=500):
+        self.columns = list(columns)
+        self.log_dir = log_dir
+        self.capacity = capacity
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_files = max_files
+        self.buffer = np.full((capacity, len(self.columns)), np.nan, dtype=np.float64)
+        # head为累计写入的行数, tail为累计写出的行数, 行在缓冲区中的位置为行号 % capacity
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self.file_seq = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+
+    def append(self, rows):
+        '''写入一行或多行, 列顺序与columns一致'''
+        try:
+            rows = np.array(rows, dtype=np.float64, ndmin=2)
+        except (TypeError, ValueError) as e:
+            log.warning("feature log row dropped: {}".format(e))
+            with self.lock:
+                self.dropped += 1
+            return
+        with self.lock:
+            for row in rows:
+                if self.head - self.tail >= self.capacity:
+                    self.tail += 1
+                    self.dropped += 1
+                self.buffer[self.head % self.capacity] = row
+                self.head += 1
+            pending = self.head - self.tail
+        if pending >= self.flush_rows:
+            self.event.set()
+
+    def pending(self):
+        '''取出未写出的行的副本, 不改变写出位置'''
+        with self.lock:
+            return self.buffer[np.arange(self.tail, self.head) % self.capacity]
+
+    def flush(self):
+        '''把未写出的行写入新文件, 返回文件路径, 没有数据时返回None'''
+        with self.flush_lock:
+            with self.lock:
+                rows = self.buffer[np.arange(self.tail, self.head) % self.capacity]
+                self.tail = self.head
+            if len(rows) == 0:
+                return None
+            os.makedirs(self.log_dir, exist_ok=True)
+            self.file_seq += 1
+            # 多进程服务时各进程写各自的文件, 文件名中加进程号
+            name = 'feature_log_{}_{}_{:06d}.npz'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid(), self.file_seq)
+            path = os.path.join(self.log_dir, name)
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, **{column: rows[:, i] for i, column in enumerate(self.columns)})
+            os.replace(path + '.tmp', path)
+            self.rotate()
+            return path
+
+    def rotate(self):
+        files = list_feature_log_files(self.log_dir)
+        for path in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # 多进程服务时可能已被其它进程删除
+                pass
+
+    def run(self):
+        while True:
+            self.event.wait(self.flush_interval)
+            self.event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("feature log flush failed: {}".format(e))
+
+    def start(self):
+        '''启动后台写出线程, 进程退出时写出剩余的行'''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='feature_log', daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def after_fork(self):
+        '''fork出的子进程中没有父进程的后台线程, 重建锁并重新启动线程'''
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+        self.start()
+
+
+def list_feature_log_files(log_dir):
+    if not os.path.isdir(log_dir):
+        return []
+    return sorted(os.path.join(log_dir, name) for name in os.listdir(log_dir)
+                  if name.startswith('feature_log_') and name.endswith('.npz'))
+
+
+def read_feature_log(log_dir, columns=None):
+    '''读取已写出的特征日志文件, 按写出顺序合并成DataFrame, columns指定只读取部分列'''
+    dfs = []
+    for path in list_feature_log_files(log_dir):
+        with np.load(path) as data:
+            dfs.append(pd.DataFrame({column: data[column] for column in (columns or data.files)}))
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(dfs, ignore_index=True)
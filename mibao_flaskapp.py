@@ -2,48 +2,58 @@
 import os
 import time
 from argparse import ArgumentParser
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request, g
 from flask import make_response
 import pandas as pd
 import json
-import lightgbm as lgb
-from sklearn.metrics import accuracy_score, recall_score
-from sklearn.model_selection import train_test_split
 import warnings
 from gevent.pywsgi import WSGIServer
 from mltools import *
 from mldata import *
 import logging
 from mibao_log import log
-import random
-from explore_data_utils import add_score
+from mibao_model import *
+from mibao_featurelog import FeatureLog, read_feature_log
+from mibao_metrics import metrics
+from mibao_cache import TTLCache
+from mibao_concurrency import offloader, serve_prefork, SingleFlight, MicroBatcher
 
 lgb_params_file = "f1.json"
+# get_order_data读取数据库的方式: serial 逐表查询, joined 一次往返查询所有表, concurrent 各表同时查询,
+# batched 与并发的其它请求合并查询
+order_fetch_mode = 'joined'
+# 等待上游数据(risk_order, tongdun, face_id_liveness)写入数据库的最长时间，单位秒
+ready_timeout = 3.0
+# 单个订单的特征用process_order_features逐行计算, False时用process_data_mibao整表处理
+row_features = True
+# 批量预测一次最多的订单数
+max_batch_orders = 1000
+# 预测结果缓存, key为(order_id, 模型版本), value为(结果, 缺失的上游数据), 最多缓存的条目数及有效时间(秒)
+prediction_cache = TTLCache(maxsize=50000, ttl=600)
+# 无数据(结果为2)或上游数据缺失时的结果只缓存这么多秒, 上游数据写入后能较快得到正常结果
+prediction_negative_ttl = 30
+# 同一订单的并发请求(如上游重试)只计算一次, 其它请求等待并返回同一结果
+predict_flight = SingleFlight('predict_order')
 log.debug(time.asctime())
 warnings.filterwarnings('ignore')
 pd.set_option('display.max_columns', 60)
-global mibaodata_ml_online_df
-mibaodata_ml_online_df = pd.DataFrame()
-# 获取训练数据
-df = pd.read_csv(os.path.join(workdir, "mibaodata_ml.csv"), encoding='utf-8', engine='python')
-print("数据量: {}".format(df.shape))
-x = df[mibao_ml_features]
-y = df['target'].tolist()
-x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.1)
-
-# 机器学习模型训练
-with open(os.path.join(workdir, lgb_params_file), 'r') as f:
-    lgb_params_auc = json.load(f)
-
-lgb_clf = lgb.LGBMClassifier(**lgb_params_auc)
-lgb_clf.fit(x_train, y_train)
-y_pred = lgb_clf.predict(x_test)
-score_df = pd.DataFrame(columns=['accuracy', 'precision', 'recall', 'f1', 'confusion_matrix'])
-add_score(score_df, 'auc', y_test, y_pred)
-log.debug(score_df)
-accuracy_score = accuracy_score(y_test, y_pred)
-
-assert accuracy_score > 0.90
+# 在线预测的特征日志, 后台线程定时写入feature_log目录
+feature_log = FeatureLog(mibao_ml_features + ['order_id'], os.path.join(workdir, 'feature_log'))
+feature_log.start()
+# 从模型仓库加载最新的有效模型(最新版本验证失败时用较旧的有效版本)，仓库中没有有效版本时用训练数据训练并发布
+model_registry = ModelRegistry(model_registry_dir, features=mibao_ml_features, min_accuracy=0.90)
+if not model_registry.check():
+    df = pd.read_csv(os.path.join(workdir, "mibaodata_ml.csv"), encoding='utf-8', engine='python')
+    print("数据量: {}".format(df.shape))
+    with open(os.path.join(workdir, lgb_params_file), 'r') as f:
+        lgb_params_auc = json.load(f)
+    publish_model_bundle(train_model_bundle(df, mibao_ml_features, mibao_cat_vocabs, lgb_params_auc))
+    model_registry.check()
+assert model_registry.model is not None
+log.debug("model {} scores: {}".format(model_registry.version, model_registry.model.scores))
+# 定时检查模型仓库, 新模型验证通过后不停服切换, 切换后旧模型的预测结果缓存不再使用
+model_registry.listeners.append(lambda model: prediction_cache.clear())
+model_registry.start()
 
 # In[]
 '''
@@ -58,40 +68,208 @@ auc score: 0.972119258662369 0.9441371681415929
 
 app = Flask(__name__)
 
-# start with order_id 105914
-@app.route('/ml_result/<int:order_id>', methods=['GET'])
-def get_predict_result(order_id):
+
+@app.before_request
+def start_request_timer():
+    g.request_start_time = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.inc('mibao_requests_total', endpoint=endpoint, status=response.status_code)
+    if response.status_code >= 500:
+        metrics.inc('mibao_request_errors_total', endpoint=endpoint)
+    if 'request_start_time' in g:
+        metrics.observe('mibao_request_seconds', time.perf_counter() - g.request_start_time, endpoint=endpoint)
+    return response
+
+
+def predict_batch(items):
+    '''items为(模型, 单行特征数组)的列表, 同一模型的行一次预测, 返回每行的结果'''
+    groups = {}
+    for i, (model, row) in enumerate(items):
+        groups.setdefault(id(model), (model, []))[1].append(i)
+    results = [None] * len(items)
+    for model, indexes in groups.values():
+        y_pred = model.predict_values(np.vstack([items[i][1] for i in indexes])) > 0.5
+        for i, y in zip(indexes, y_pred):
+            results[i] = int(y)
+    return results
+
+
+# 微批预测: 并发请求的特征行最多等待max_wait秒或凑满max_batch行后一次预测, max_wait为0时不合并
+predict_batcher = MicroBatcher(predict_batch, max_batch=32, max_wait=0)
+
+
+def predict_first_row(model, x):
+    '''预测x(按模型特征排列的二维数组)的第一行, 启用微批时与其它请求的行合并预测'''
+    if predict_batcher.max_wait > 0:
+        return predict_batcher.submit((model, x[:1]))
+    with offloader.cpu_bound():
+        return int(model.predict_values(x[:1])[0] > 0.5)
+
+
+def predict_order(order_id):
+    '''预测单个订单, 返回结果(无数据时为2), 缺失的上游数据及使用的模型版本'''
     # log.debug("order_id: {}".format(order_id))
-    global mibaodata_ml_online_df
-    time.sleep(3)
+    # 整个请求使用同一个模型，处理过程中模型切换不影响本次请求
+    lgb_clf = model_registry.model
+    # 同一订单、同一模型的缓存结果在等待上游数据之前查找, 上游数据一直缺失的订单重试时不用再等待
+    cache_key = (order_id, lgb_clf.version)
+    cached = prediction_cache.get(cache_key)
+    if cached is not None:
+        log.debug("order_id {} result from cache: {}".format(order_id, cached))
+        return cached[0], list(cached[1]), lgb_clf.version
+    with metrics.timer('mibao_stage_seconds', stage='ready_wait'):
+        missing_inputs = wait_order_data_ready(order_id, mibao_ml_features, timeout=ready_timeout)
+    if len(missing_inputs) > 0:
+        log.warning("order_id {} missing inputs after {}s: {}".format(order_id, ready_timeout, missing_inputs))
     ret_data = 2
-    df = get_order_data(order_id, is_sql=True)
+    with metrics.timer('mibao_stage_seconds', stage='fetch'):
+        df = get_order_data(order_id, is_sql=True, fetch_mode=order_fetch_mode)
     if len(df) != 0:
         log.debug(df[['order_id', 'state', 'state_cao']])
-        df = process_data_mibao(df)
-        df = df[mibao_ml_features]
+        with offloader.cpu_bound():
+            if row_features:
+                # 逐行计算时直接按模型特征的顺序生成, 选取特征包含在process阶段中
+                with metrics.timer('mibao_stage_seconds', stage='process'):
+                    x = process_order_features(df, lgb_clf.cat_vocabs, lgb_clf.features)
+            else:
+                with metrics.timer('mibao_stage_seconds', stage='process'):
+                    df = process_data_mibao(df, lgb_clf.cat_vocabs)
+                with metrics.timer('mibao_stage_seconds', stage='select'):
+                    x = df[lgb_clf.features].values.astype(np.float64) if len(df) > 0 else None
         # print(list(set(all_data_df.columns.tolist()).difference(set(df.columns.tolist()))))
-        y_pred = lgb_clf.predict(df)
-        ret_data = y_pred[0]
-        df['order_id'] = order_id
-        mibaodata_ml_online_df = pd.concat([mibaodata_ml_online_df, df], axis=0)
+        # 所有行都被特征处理删除(如缺少身份证号)时与无数据相同
+        if x is not None:
+            with metrics.timer('mibao_stage_seconds', stage='predict'):
+                ret_data = predict_first_row(lgb_clf, x)
+            feature_log.append(np.append(x[:1], [[order_id]], axis=1))
+    complete = int(ret_data) != 2 and len(missing_inputs) == 0
+    prediction_cache.set(cache_key, (int(ret_data), tuple(missing_inputs)),
+                         ttl=None if complete else prediction_negative_ttl)
     log.debug("order_id {} result: {}".format(order_id, ret_data))
     # print("reference:", all_data_df[all_data_df['order_id'] == order_id])
-    return jsonify({"code": 200, "data": {"result": int(ret_data)}, "message": "SUCCESS"}), 200
+    return int(ret_data), missing_inputs, lgb_clf.version
+
+
+# start with order_id 105914
+@app.route('/ml_result/<int:order_id>', methods=['GET'])
+def get_predict_result(order_id):
+    result, missing_inputs, model_version = offloader.run(predict_flight.do, order_id, predict_order, order_id)
+    return jsonify({"code": 200, "data": {"result": result, "missing": missing_inputs,
+                                          "model_version": model_version},
+                    "message": "SUCCESS"}), 200
+
+
+def predict_orders(order_ids):
+    '''批量预测订单, 每个表只查询一次、模型只预测一次
+
+    返回order_id到结果的字典(无数据的订单结果为2)及使用的模型版本
+    '''
+    lgb_clf = model_registry.model
+    results = dict.fromkeys(order_ids, 2)
+    with metrics.timer('mibao_stage_seconds', stage='batch_fetch'):
+        df = get_orders_data(order_ids, is_sql=True)
+    if len(df) != 0:
+        with offloader.cpu_bound():
+            with metrics.timer('mibao_stage_seconds', stage='batch_process'):
+                df = process_data_mibao(df, lgb_clf.cat_vocabs)
+                # 合并后一个订单可能有多行, 与单个订单的预测相同, 只用每个订单的第一行
+                df = df.drop_duplicates('order_id', keep='first')
+            with metrics.timer('mibao_stage_seconds', stage='batch_predict'):
+                y_pred = lgb_clf.predict(df[lgb_clf.features])
+        results.update(zip(df['order_id'].tolist(), y_pred))
+    return results, lgb_clf.version
+
+
+@app.route('/ml_result/batch', methods=['POST'])
+def get_batch_predict_result():
+    data = request.get_json(silent=True)
+    order_ids = data.get('order_ids') if isinstance(data, dict) else None
+    try:
+        # 请求体不是对象或order_ids不是列表(如字符串"123")时都按格式错误处理
+        if not isinstance(order_ids, list):
+            raise TypeError("order_ids must be a list")
+        order_ids = list(dict.fromkeys(int(x) for x in order_ids))
+    except (TypeError, ValueError):
+        return jsonify({"code": 400, "message": "order_ids must be a list of integers"}), 400
+    if len(order_ids) == 0 or len(order_ids) > max_batch_orders:
+        return jsonify({"code": 400, "message": "order_ids size must be 1~{}".format(max_batch_orders)}), 400
+
+    results, model_version = offloader.run(predict_orders, order_ids)
+    log.debug("batch of {} orders, results: {}".format(len(order_ids), results))
+    return jsonify({"code": 200, "data": {"results": [{"order_id": order_id, "result": int(results[order_id])}
+                                                      for order_id in order_ids],
+                                         "model_version": model_version},
+                    "message": "SUCCESS"}), 200
+
+
+@app.route('/model/version', methods=['GET'])
+def get_model_version():
+    model = model_registry.model
+    return jsonify({"code": 200, "data": {"version": model.version, "loaded_time": model_registry.loaded_time,
+                                          "scores": model.scores, "rejected": model_registry.rejected},
+                    "message": "SUCCESS"}), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    metrics.set('mibao_feature_log_dropped', feature_log.dropped)
+    metrics.set('mibao_feature_log_pending', feature_log.head - feature_log.tail)
+    for cache_name, cache in [('prediction', prediction_cache), ('user_feature', user_feature_cache)]:
+        stats = cache.stats()
+        for key, value in stats.items():
+            metrics.set('mibao_cache_' + key, value, cache=cache_name)
+        lookups = stats['hits'] + stats['misses']
+        metrics.set('mibao_cache_hit_ratio', stats['hits'] / lookups if lookups > 0 else 0, cache=cache_name)
+    metrics.set('mibao_singleflight_in_flight', predict_flight.in_flight(), group=predict_flight.name)
+    for key, value in sql_connection.pool_stats().items():
+        metrics.set('mibao_db_pool_' + key, value)
+    return make_response(metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+@app.route('/cache/user/<int:user_id>', methods=['DELETE'])
+def invalidate_user(user_id):
+    '''用户资料、认证等数据变化后由业务系统调用, 可用{"tables":[...]}只删除部分表'''
+    tables = (request.get_json(silent=True) or {}).get('tables')
+    if tables is not None and not set(tables) <= set(user_cache_ttls):
+        return jsonify({"code": 400, "message": "tables must be in {}".format(sorted(user_cache_ttls))}), 400
+    deleted = invalidate_user_cache(user_id, tables)
+    log.debug("user {} cache invalidated, {} entries deleted".format(user_id, deleted))
+    return jsonify({"code": 200, "data": {"deleted": deleted}, "message": "SUCCESS"}), 200
+
+
+def dump_feature_log(path='mibaodata_ml_online.csv'):
+    '''写出缓冲区中的特征日志, 再把所有日志文件合并导出为csv'''
+    feature_log.flush()
+    read_feature_log(feature_log.log_dir).to_csv(path, index=False)
 
 
 @app.route('/debug/<int:debug>', methods=['GET'])
 def set_debug_mode(debug):
-    global mibaodata_ml_online_df
     if debug == 1:
         log.setLevel(logging.DEBUG)
     else:
         log.setLevel(logging.INFO)
-    mibaodata_ml_online_df.to_csv('mibaodata_ml_online.csv', index=False)
+    # 读取几百个日志文件并写csv较慢, 在线程池中执行, 不阻塞其它请求
+    offloader.run(dump_feature_log)
     print("log mode: {}".format(log.level))
     return jsonify({'log_mode': int(log.level)}), 201
 
 
+def after_fork():
+    '''多进程服务的工作进程启动时调用'''
+    sql_connection.after_fork()
+    metrics.after_fork(pid=os.getpid())
+    feature_log.after_fork()
+    prediction_cache.after_fork()
+    user_feature_cache.after_fork()
+    model_registry.after_fork()
+    offloader.start(offloader.io_workers, offloader.cpu_workers)
+
+
 @app.errorhandler(404)
 def not_found():
     return make_response(jsonify({'error': 'bug'}), 404)
@@ -99,13 +277,47 @@ def not_found():
 
 if __name__ == '__main__':
     opt = ArgumentParser()
-    opt.add_argument('--model', default='gevent')
+    opt.add_argument('--model', default='gevent', choices=['gevent', 'prefork', 'raw'])
+    opt.add_argument('--workers', default=os.cpu_count(), type=int, help='prefork模式的工作进程数')
+    opt.add_argument('--lgb_threads', default=0, type=int, help='lightgbm预测线程数, prefork模式默认为1')
+    opt.add_argument('--fetch_mode', default=order_fetch_mode, choices=['serial', 'joined', 'concurrent', 'batched'])
+    opt.add_argument('--ready_timeout', default=ready_timeout, type=float)
+    opt.add_argument('--cache_ttl', default=prediction_cache.ttl, type=float)
+    opt.add_argument('--cache_size', default=prediction_cache.maxsize, type=int)
+    opt.add_argument('--negative_ttl', default=prediction_negative_ttl, type=float,
+                     help='无数据或上游数据缺失的结果缓存的秒数')
+    opt.add_argument('--user_cache', default=1, type=int, help='0: 不缓存按user_id读取的表')
+    opt.add_argument('--row_features', default=1, type=int, help='0: 单个订单也用process_data_mibao整表处理')
+    opt.add_argument('--io_workers', default=offloader.io_workers, type=int, help='gevent模式执行预测的线程数')
+    opt.add_argument('--cpu_workers', default=offloader.cpu_workers, type=int, help='同时进行特征处理和预测的线程数')
+    opt.add_argument('--batch_wait', default=predict_batcher.max_wait * 1000, type=float,
+                     help='微批预测的最长等待时间(毫秒), 0为不合并')
+    opt.add_argument('--batch_size', default=predict_batcher.max_batch, type=int, help='微批预测每批最多的行数')
     args = opt.parse_args()
+    order_fetch_mode = args.fetch_mode
+    ready_timeout = args.ready_timeout
+    prediction_cache.ttl = args.cache_ttl
+    prediction_cache.maxsize = args.cache_size
+    prediction_negative_ttl = args.negative_ttl
+    predict_batcher.max_wait = args.batch_wait / 1000
+    predict_batcher.max_batch = args.batch_size
+    if args.user_cache == 0:
+        user_cache_ttls.clear()
+    row_features = args.row_features != 0
 
     if args.model == 'gevent':
+        MibaoModel.num_threads = args.lgb_threads
+        offloader.start(args.io_workers, args.cpu_workers)
         http_server = WSGIServer(('0.0.0.0', 5000), app)
         print('listen on 0.0.0.0:5000')
         http_server.serve_forever()
+    elif args.model == 'prefork':
+        # 每个进程一个lightgbm线程, 避免多个进程的线程争抢CPU
+        MibaoModel.num_threads = args.lgb_threads or 1
+        offloader.io_workers, offloader.cpu_workers = args.io_workers, args.cpu_workers
+        # 在主进程建立数据库连接(及SSH隧道), 工作进程共用
+        get_sql_engine()
+        serve_prefork(app, 5000, args.workers, after_fork, feature_log.flush)
     elif args.model == 'raw':
         app.run(host='0.0.0.0')
 
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding: utf-8
+# @Time : 2026/10/18 18:20
+# @Author : yangpingyan@gmail.com
+
+import re
+import json
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_missing = object()
+
+
+def json_loads(text):
+    '''解析json字符串, 安装了orjson时优先使用
+
+    orjson不支持NaN、Infinity及超过64位的整数, 这些数据改用json模块解析, 结果与json.loads相同。
+    '''
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
+
+
+json_decoder = json.JSONDecoder()
+json_whitespace = re.compile(r'[ \t\n\r]*')
+json_whitespace_chars = frozenset(' \t\n\r')
+
+
+def iter_json_array(text):
+    '''逐个解析json数组的元素, 不生成整个列表
+
+    用于很长的数组(如通讯录)只需遍历一次的情况, 同时只保留一个元素; 元素的解析与json.loads相同,
+    格式错误时同样抛出json.JSONDecodeError。text不是数组时返回json.loads结果的迭代器。
+    '''
+    skip = json_whitespace.match
+    pos = skip(text, 0).end()
+    if not text.startswith('[', pos):
+        yield from json_loads(text)
+        return
+    pos = skip(text, pos + 1).end()
+    if not text.startswith(']', pos):
+        # 直接调用json.loads使用的扫描函数, 每个元素少一次python函数调用
+        scan_once = json_decoder.scan_once
+        while True:
+            try:
+                value, pos = scan_once(text, pos)
+            except StopIteration as e:
+                raise json.JSONDecodeError("Expecting value", text, e.value) from None
+            yield value
+            c = text[pos:pos + 1]
+            if c in json_whitespace_chars:
+                pos = skip(text, pos).end()
+                c = text[pos:pos + 1]
+            if c == ',':
+                pos += 1
+                if text[pos:pos + 1] in json_whitespace_chars:
+                    pos = skip(text, pos).end()
+            elif c == ']':
+                break
+            else:
+                raise json.JSONDecodeError("Expecting ',' delimiter", text, pos)
+    pos = skip(text, pos + 1).end()
+    if pos != len(text):
+        raise json.JSONDecodeError("Extra data", text, pos)
+
+
+class JsonColumn(object):
+    '''声明从json字符串列中取出的字段, 每个json字符串只解析一次
+
+    add注册字段: path为依次取值的键(或列表下标)的元组, None为整个json;
+    convert转换取到的值; 不是字符串或取不到值时为default。
+    extract对整列取值, 返回字段名到numpy数组的字典; extract_row对单个json字符串取值, 返回字段值的列表。
+    '''
+
+    def __init__(self, loads=None):
+        self.loads = json_loads if loads is None else loads
+        self.fields = []
+
+    def add(self, name, path=None, default=None, convert=None, dtype=object):
+        self.fields.append((name, path, default, convert, dtype))
+        return self
+
+    @staticmethod
+    def get_path(value, path):
+        for key in path:
+            if isinstance(value, dict):
+                value = value.get(key, _missing)
+            elif isinstance(value, list) and isinstance(key, int) and -len(value) <= key < len(value):
+                value = value[key]
+            else:
+                return _missing
+            if value is _missing:
+                return _missing
+        return value
+
+    def extract_row(self, text):
+        if not isinstance(text, str):
+            return [default for _, _, default, _, _ in self.fields]
+        data = self.loads(text)
+        row = []
+        for name, path, default, convert, dtype in self.fields:
+            value = data if path is None else self.get_path(data, path)
+            if value is _missing:
+                row.append(default)
+            else:
+                row.append(value if convert is None else convert(value))
+        return row
+
+    def extract(self, values):
+        # 同一个json字符串(如重复的订单数据)只解析一次
+        cache = {}
+        rows = []
+        for text in values:
+            if isinstance(text, str):
+                row = cache.get(text)
+                if row is None:
+                    row = cache[text] = self.extract_row(text)
+            else:
+                row = self.extract_row(text)
+            rows.append(row)
+        columns = list(zip(*rows)) if len(rows) > 0 else [()] * len(self.fields)
+        return {name: to_array(column, dtype) for (name, _, _, _, dtype), column in zip(self.fields, columns)}
+
+
+def to_array(values, dtype):
+    if np.dtype(dtype) != object:
+        return np.array(values, dtype=dtype)
+    # 值为列表或字典时np.array会生成多维数组, 逐个赋值
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding: utf-8
+# @Time : 2026/10/18 16:02
+# @Author : yangpingyan@gmail.com
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# 延迟直方图的桶上界, 单位秒
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    '''进程内的计数器、数值和直方图, render输出Prometheus文本格式'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.helps = {}
+        self.values = {}
+        # 所有指标都带的标签, 如多进程服务中的进程号
+        self.const_labels = ()
+
+    def _get(self, metric_type, name, labels, factory):
+        key = (name, tuple(sorted(labels.items())))
+        value = self.values.get(key)
+        if value is None:
+            self.types.setdefault(name, metric_type)
+            value = self.values[key] = factory()
+        return key, value
+
+    def describe(self, name, help_text):
+        self.helps[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        '''计数器加value'''
+        with self.lock:
+            key, old = self._get('counter', name, labels, int)
+            self.values[key] = old + value
+
+    def set(self, name, value, **labels):
+        '''设置当前值(gauge)'''
+        with self.lock:
+            key, _ = self._get('gauge', name, labels, int)
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        '''延迟等数值计入直方图'''
+        with self.lock:
+            _, histogram = self._get('histogram', name, labels, Histogram)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''统计with语句块的耗时, 异常退出时也计入'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get(self, name, **labels):
+        '''计数器或gauge的当前值, 直方图返回(count, sum)'''
+        with self.lock:
+            value = self.values.get((name, tuple(sorted(labels.items()))), 0)
+            return (value.count, value.sum) if isinstance(value, Histogram) else value
+
+    def after_fork(self, **labels):
+        '''fork出的子进程中重建锁并清空从父进程复制的值, labels加到所有指标上
+
+        多进程服务中每个工作进程的计数各自累计, 每次抓取由任一进程响应;
+        加上进程号等标签后各进程的指标是不同的序列, 各自单调递增, 可以用sum聚合
+        '''
+        self.lock = threading.Lock()
+        self.values = {}
+        self.const_labels = tuple(sorted(labels.items()))
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items(), key=lambda item: item[0])
+            lines = []
+            last_name = None
+            for (name, labels), value in items:
+                labels = self.const_labels + labels
+                if name != last_name:
+                    if name in self.helps:
+                        lines.append("# HELP {} {}".format(name, self.helps[name]))
+                    lines.append("# TYPE {} {}".format(name, self.types[name]))
+                    last_name = name
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(list(value.buckets) + ['+Inf'], value.counts):
+                        cumulative += count
+                        lines.append("{}_bucket{} {}".format(name, _format_labels(labels + (('le', bound),)),
+                                                             cumulative))
+                    lines.append("{}_sum{} {}".format(name, _format_labels(labels), value.sum))
+                    lines.append("{}_count{} {}".format(name, _format_labels(labels), value.count))
+                else:
+                    lines.append("{}{} {}".format(name, _format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + "}"
+
+
+# 进程内共用的指标
+metrics = Metrics()
+metrics.describe('mibao_stage_seconds', 'Latency of each scoring stage in seconds')
+metrics.describe('mibao_table_fetch_seconds', 'Latency of each database table read in seconds')
+metrics.describe('mibao_request_seconds', 'Latency of each HTTP endpoint in seconds')
+metrics.describe('mibao_requests_total', 'HTTP requests by endpoint and status')
+metrics.describe('mibao_request_errors_total', 'HTTP requests that returned 5xx')
+metrics.describe('mibao_singleflight_calls_total', 'Calls executed by a single-flight group')
+metrics.describe('mibao_singleflight_coalesced_total', 'Calls that waited for and shared an in-flight result')
+metrics.describe('mibao_batches_total', 'Batches run by a micro-batcher')
+metrics.describe('mibao_batch_rows_total', 'Rows submitted to a micro-batcher')
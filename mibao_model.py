@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# coding: utf-8
+# @Time : 2026/10/18 10:12
+# @Author : yangpingyan@gmail.com
+
+import os
+import time
+import json
+import pickle
+import threading
+import numpy as np
+import lightgbm as lgb
+from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, confusion_matrix
+from sklearn.model_selection import train_test_split
+from mltools import *
+from mibao_log import log
+from mibao_treepredict import TreePredictor, export_tree_arrays
+
+# 模型仓库目录, 训练脚本把模型包保存为<version>.pkl, 服务使用其中最新的有效版本
+model_registry_dir = os.path.join(workdir, 'models')
+
+
+class MibaoModel(object):
+    '''模型包的预测接口，predict的返回值与LGBMClassifier.predict一致'''
+
+    # booster多行预测使用的线程数, 0为lightgbm的默认值(所有核), 多进程服务时每个进程设为1
+    num_threads = 0
+
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.version = bundle['version']
+        self.features = bundle['features']
+        self.cat_vocabs = bundle['cat_vocabs']
+        self.params = bundle['params']
+        self.scores = bundle['scores']
+        self.booster = lgb.Booster(model_str=bundle['booster'])
+        # 单行预测不经过lightgbm, 直接用展开成数组的树计算, 结果与booster逐位一致
+        self.trees = TreePredictor(export_tree_arrays(bundle['booster']))
+
+    def predict_proba(self, df):
+        '''返回审核通过(target为1)的概率'''
+        return self.predict_values(df[self.features].values)
+
+    def predict_values(self, x):
+        '''x为按features顺序排列的二维数组, 返回概率'''
+        x = np.asarray(x, dtype=np.float64)
+        if len(x) == 1:
+            return np.array([self.trees.predict_row(x[0])])
+        if self.num_threads > 0:
+            return self.booster.predict(x, num_threads=self.num_threads)
+        return self.booster.predict(x)
+
+    def predict(self, df):
+        # 二分类时LGBMClassifier取概率较大的类别，概率相等时为0
+        return (self.predict_proba(df) > 0.5).astype(int)
+
+
+def train_model_bundle(df, features, cat_vocabs, params, test_size=0.1, random_state=88):
+    '''训练模型并生成模型包: booster, 特征顺序, 类别特征取值, 模型参数, 评估得分'''
+    x = df[features]
+    y = df['target'].astype(int).tolist()
+    x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=test_size, random_state=random_state)
+
+    params = dict(params)
+    if params.get('random_state') is None:
+        params['random_state'] = random_state
+    lgb_clf = lgb.LGBMClassifier(**params)
+    lgb_clf.fit(x_train, y_train)
+    y_pred = lgb_clf.predict(x_test)
+    validation_num = 200
+    scores = {'accuracy': accuracy_score(y_test, y_pred), 'precision': precision_score(y_test, y_pred),
+              'recall': recall_score(y_test, y_pred), 'f1': f1_score(y_test, y_pred),
+              'confusion_matrix': confusion_matrix(y_test, y_pred).tolist()}
+
+    bundle = {'version': time.strftime('%Y%m%d%H%M%S'),
+              'booster': lgb_clf.booster_.model_to_string(),
+              'features': list(features),
+              'cat_vocabs': {feature: list(values) for feature, values in cat_vocabs.items()},
+              'params': params,
+              'scores': scores,
+              'train_size': len(x_train),
+              # 加载模型包时用这部分测试数据验证预测结果与训练时一致
+              'validation_x': x_test.head(validation_num),
+              'validation_pred': y_pred[:validation_num].tolist()}
+    return bundle
+
+
+def save_model_bundle(bundle, path):
+    '''先写临时文件再替换，避免服务读到写了一半的模型包'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    log.debug("model bundle {} saved to {}".format(bundle['version'], path))
+
+
+def load_model_bundle(path):
+    with open(path, 'rb') as f:
+        bundle = pickle.load(f)
+    return bundle
+
+
+def publish_model_bundle(bundle, registry_dir=model_registry_dir):
+    '''把模型包发布到模型仓库, 正在运行的服务会自动切换到这个版本'''
+    os.makedirs(registry_dir, exist_ok=True)
+    path = os.path.join(registry_dir, bundle['version'] + '.pkl')
+    save_model_bundle(bundle, path)
+    return path
+
+
+def validate_model(model, features, min_accuracy=0.90):
+    '''检查模型能否用于线上预测, 返回不通过的原因, 通过时返回None'''
+    if model.features != list(features):
+        return "features mismatch"
+    if model.scores.get('accuracy', 0) <= min_accuracy:
+        return "accuracy {} <= {}".format(model.scores.get('accuracy', 0), min_accuracy)
+    validation_x = model.bundle.get('validation_x')
+    if validation_x is not None and model.predict(validation_x).tolist() != model.bundle['validation_pred']:
+        return "predictions differ from training"
+    return None
+
+
+class ModelRegistry(object):
+    '''监视模型仓库目录, 新版本验证通过后替换当前模型
+
+    替换只是重新给self.model赋值, 请求开始时取一次registry.model并一直使用它,
+    处理中的请求不受替换影响。
+    '''
+
+    def __init__(self, registry_dir=model_registry_dir, features=None, min_accuracy=0.90, interval=10):
+        self.registry_dir = registry_dir
+        self.features = features
+        self.min_accuracy = min_accuracy
+        self.interval = interval
+        self.model = None
+        self.loaded_time = None
+        self.rejected = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        # 切换模型后调用的函数, 参数为新模型
+        self.listeners = []
+
+    @property
+    def version(self):
+        return None if self.model is None else self.model.version
+
+    def list_versions(self):
+        if not os.path.isdir(self.registry_dir):
+            return []
+        return sorted(os.path.splitext(name)[0] for name in os.listdir(self.registry_dir) if name.endswith('.pkl'))
+
+    def check(self):
+        '''从新到旧加载仓库中第一个验证通过的版本, 切换成功返回True
+
+        最新版本验证失败时退回到较旧的有效版本; 遇到当前版本时停止, 不会换成比当前更旧的版本。
+        '''
+        with self.lock:
+            model = None
+            for version in reversed(self.list_versions()):
+                if version == self.version:
+                    return False
+                if version in self.rejected:
+                    continue
+                try:
+                    model = MibaoModel(load_model_bundle(os.path.join(self.registry_dir, version + '.pkl')))
+                    error = validate_model(model, self.features or model.features, self.min_accuracy)
+                except Exception as e:
+                    error = repr(e)
+                if error is None:
+                    break
+                self.rejected[version] = error
+                log.warning("model {} rejected: {}".format(version, error))
+                model = None
+            if model is None:
+                return False
+            old_version = self.version
+            self.model = model
+            self.loaded_time = time.strftime('%Y-%m-%d %H:%M:%S')
+            log.info("model switched from {} to {}".format(old_version, version))
+        for listener in self.listeners:
+            listener(model)
+        return True
+
+    def watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                log.error("model registry check failed: {}".format(e))
+
+    def start(self):
+        '''启动后台线程定时检查模型仓库'''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.watch, name='model_registry', daemon=True)
+            self.thread.start()
+
+    def after_fork(self):
+        '''fork出的子进程中重建锁并重新启动检查线程, 之后各进程各自加载新版本'''
+        self.lock = threading.Lock()
+        self.thread = None
+        self.start()
+
+
+if __name__ == '__main__':
+    import pandas as pd
+    from mldata import mibao_ml_features, mibao_cat_vocabs
+
+    df = pd.read_csv(os.path.join(workdir, "mibaodata_ml.csv"), encoding='utf-8', engine='python')
+    print("数据量: {}".format(df.shape))
+    with open(os.path.join(workdir, "f1.json"), 'r') as f:
+        lgb_params = json.load(f)
+    bundle = train_model_bundle(df, mibao_ml_features, mibao_cat_vocabs, lgb_params)
+    print(bundle['scores'])
+    publish_model_bundle(bundle)
@@ -134,6 +134,195 @@ for order_id in order_ids:
 print("final result {}".format(error_ids))
 
 
+# In[]
+# 检查一次往返读取(joined)、并发读取(concurrent)、合并读取(batched)与逐表读取(serial)的get_order_data结果是否一致
+# joined先在缓存为空时读取一次(一并查询按user_id读取的表), 再使用serial写入的缓存读取一次
+error_ids = []
+for order_id in order_ids:
+    user_feature_cache.clear()
+    joined_df = get_order_data(order_id, is_sql=True, fetch_mode='joined')
+    serial_df = get_order_data(order_id, is_sql=True, fetch_mode='serial')
+    try:
+        pd.testing.assert_frame_equal(serial_df, joined_df)
+    except AssertionError as e:
+        error_ids.append(order_id)
+        print("fetch_mode joined without cache mismatch with order_id {}: {}".format(order_id, e))
+    for fetch_mode in ['joined', 'concurrent', 'batched']:
+        fetch_df = get_order_data(order_id, is_sql=True, fetch_mode=fetch_mode)
+        try:
+            pd.testing.assert_frame_equal(serial_df, fetch_df)
+        except AssertionError as e:
+            error_ids.append(order_id)
+            print("fetch_mode {} mismatch with order_id {}: {}".format(fetch_mode, order_id, e))
+
+# 多个请求同时读取时合并成一批IN查询, 每个订单的结果(包括数据类型)应与逐表读取相同
+from concurrent.futures import ThreadPoolExecutor
+
+with ThreadPoolExecutor(max_workers=32) as pool:
+    batched_dfs = list(pool.map(lambda order_id: get_order_data(order_id, is_sql=True, fetch_mode='batched'),
+                                order_ids))
+for order_id, batched_df in zip(order_ids, batched_dfs):
+    try:
+        pd.testing.assert_frame_equal(get_order_data(order_id, is_sql=True, fetch_mode='serial'), batched_df)
+    except AssertionError as e:
+        error_ids.append(order_id)
+        print("concurrent batched mismatch with order_id {}: {}".format(order_id, e))
+
+print("fetch_mode result {}".format(error_ids))
+
+
+# In[]
+# 检查批量读取(get_orders_data)与逐个读取订单的特征是否一致, 以及每个订单第一行的预测结果是否一致
+batch_df = process_data_mibao(get_orders_data(order_ids, is_sql=True))
+first_df = batch_df.drop_duplicates('order_id', keep='first')
+batch_pred = dict(zip(first_df['order_id'].tolist(), lgb_clf.predict(first_df[mibao_ml_features])))
+error_ids = []
+for order_id in order_ids:
+    df = process_data_mibao(get_order_data(order_id, is_sql=True))
+    base_df = batch_df[batch_df['order_id'] == order_id]
+    cmp_df = pd.concat([base_df[mibao_ml_features], df[mibao_ml_features]])
+    if len(base_df) != len(df) or cmp_df.std().sum() > 0:
+        error_ids.append(order_id)
+        print("batch mismatch with order_id {}".format(order_id))
+    y_pred = lgb_clf.predict(df[mibao_ml_features][:1])[0] if len(df) > 0 else 2
+    if batch_pred.get(order_id, 2) != y_pred:
+        error_ids.append(order_id)
+        print("batch predict mismatch with order_id {}".format(order_id))
+
+print("batch result {}".format(error_ids))
+
+
+# In[]
+# 检查逐行计算的单个订单特征(process_order_features)与process_data_mibao整表处理的结果是否一致
+# 使用datasets目录中保存的各表数据, 每个订单取process_data_mibao结果中的第一行
+corpus_df = get_orders_data([], is_sql=False)  # 从文件读取时返回所有订单
+bulk_df = process_data_mibao(corpus_df.copy()).drop_duplicates('order_id').set_index('order_id')
+error_ids = []
+for order_id, order_df in corpus_df.groupby('order_id', sort=False):
+    x = process_order_features(order_df)
+    if order_id not in bulk_df.index:
+        if x is not None:
+            error_ids.append(order_id)
+            print("row features should be dropped with order_id {}".format(order_id))
+        continue
+    base_x = bulk_df.loc[[order_id], mibao_ml_features].values.astype(np.float64)
+    if x is None or not np.array_equal(base_x, x, equal_nan=True):
+        error_ids.append(order_id)
+        print("row features mismatch with order_id {}".format(order_id))
+
+print("row features result {}".format(error_ids))
+
+
+# In[]
+# 检查逐个解析联系人的通讯录计数与解析整个json的结果是否一致
+phone_books = read_mlfile('order_phone_book', order_phone_book_features)['phone_book'].tolist()
+expected = [count_name_nums(json.loads(x)) if isinstance(x, str) else 0 for x in phone_books]
+print("phone_book result {}".format((phone_book_json.extract(phone_books)['phone_book'] == expected).all()))
+
+
+# In[]
+# 检查增量导出: 本地sqlite库代替MySQL, 新增和修改数据后增量导出的csv应与全量导出相同, 全量核对时去掉已删除的行;
+# 增量导出时多个表并发导出
+import tempfile
+from sqlalchemy.pool import NullPool
+from mibao_export import ExportState, export_table, export_tables
+
+export_dir = tempfile.mkdtemp()
+export_connection = SqlConnection(url='sqlite:///' + os.path.join(export_dir, 'export.db'),
+                                  pool_options={'poolclass': NullPool})
+export_features = {'order': ['id', 'state', 'pay_num'], 'order_detail': ['order_id', 'order_detail'],
+                 'bargain_help': ['user_id']}
+pd.DataFrame({'id': range(1000), 'update_time': pd.date_range('2018-11-01', periods=1000, freq='min').astype(str),
+              'state': 'pending',
+              'pay_num': np.random.rand(1000)}).to_sql('order', export_connection.engine, index=False)
+pd.DataFrame({'id': range(1000), 'order_id': range(1000),
+              'order_detail': ['{{"xiaobaiScore": {}}}'.format(i) for i in range(1000)]}).to_sql(
+    'order_detail', export_connection.engine, index=False)
+pd.DataFrame({'user_id': range(100)}).to_sql('bargain_help', export_connection.engine, index=False)
+
+
+def export_all(export_path, incremental=True, full_interval=7 * 24 * 3600):
+    state = ExportState(os.path.join(export_path, 'export_state.json'))
+    if incremental:
+        return export_tables(export_connection, list(export_features.items()), export_path, state, 3,
+                             incremental=incremental, full_interval=full_interval)
+    for table, features in export_features.items():
+        export_table(export_connection, table, features, os.path.join(export_path, table + '.csv'), state,
+                     incremental, full_interval)
+
+
+def read_export(export_path, table):
+    df = pd.read_csv(os.path.join(export_path, table + '.csv'), dtype=str, keep_default_na=False)
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def compare_exports(incremental_path, full_path):
+    return all(read_export(incremental_path, table).equals(read_export(full_path, table)) for table in export_features)
+
+
+incremental_path, full_path = os.path.join(export_dir, 'incremental'), os.path.join(export_dir, 'full')
+os.makedirs(incremental_path)
+os.makedirs(full_path)
+export_all(incremental_path)
+with export_connection.engine.begin() as conn:
+    conn.exec_driver_sql("UPDATE `order` SET state = 'passed', update_time = '2018-11-02 00:00:00' WHERE id < 100")
+    conn.exec_driver_sql("INSERT INTO `order` VALUES (1000, '2018-11-02 00:00:00', 'pending', 0.5)")
+    conn.exec_driver_sql("INSERT INTO order_detail VALUES (1000, 1000, '{}')")
+    conn.exec_driver_sql("INSERT INTO bargain_help VALUES (100)")
+export_all(incremental_path)
+export_all(full_path, incremental=False)
+print("incremental export result {}".format(compare_exports(incremental_path, full_path)))
+
+# 没有变化时增量导出不读取任何行; 与上次最大update_time同一时刻写入的行也要导出
+print("unchanged export rows {}".format(export_all(incremental_path)))
+with export_connection.engine.begin() as conn:
+    conn.exec_driver_sql("INSERT INTO `order` VALUES (1001, '2018-11-02 00:00:00', 'pending', 0.6)")
+export_all(incremental_path)
+export_all(full_path, incremental=False)
+print("same time export result {}".format(compare_exports(incremental_path, full_path)))
+
+with export_connection.engine.begin() as conn:
+    conn.exec_driver_sql("DELETE FROM `order` WHERE id >= 900")
+export_all(incremental_path, full_interval=0)
+export_all(full_path, incremental=False)
+print("full reconciliation result {}".format(compare_exports(incremental_path, full_path)))
+export_connection.close()
+
+
+# In[]
+# 检查不依赖lightgbm的树模型预测与booster的得分是否逐位一致
+from mibao_model import ModelRegistry
+from mibao_treepredict import TreePredictor, export_tree_arrays
+
+model_registry = ModelRegistry(features=mibao_ml_features)
+model_registry.check()
+model = model_registry.model
+tree_predictor = TreePredictor(export_tree_arrays(model.bundle['booster']))
+x = all_data_ml_df[mibao_ml_features].values.astype(np.float64)
+booster_raw = model.booster.predict(x, raw_score=True)
+booster_proba = model.booster.predict(x)
+print("vectorized raw parity:", (tree_predictor.predict_raw(x) == booster_raw).all())
+print("vectorized proba parity:", (tree_predictor.predict(x) == booster_proba).all())
+row_proba = np.array([tree_predictor.predict_row(row) for row in x[:1000]])
+print("scalar proba parity:", (row_proba == booster_proba[:1000]).all())
+
+
+# In[]
+# 最新版本验证失败时模型仓库退回到较旧的有效版本, 并且不再重复加载失败的版本
+import shutil
+import tempfile
+
+fallback_dir = tempfile.mkdtemp()
+shutil.copy(os.path.join(model_registry.registry_dir, model_registry.version + '.pkl'),
+            os.path.join(fallback_dir, model_registry.version + '.pkl'))
+with open(os.path.join(fallback_dir, 'zzzz_broken.pkl'), 'wb') as f:
+    f.write(b'not a model bundle')
+fallback_registry = ModelRegistry(fallback_dir, features=mibao_ml_features)
+print("fallback loaded:", fallback_registry.check() and fallback_registry.version == model_registry.version)
+print("broken rejected:", 'zzzz_broken' in fallback_registry.rejected and not fallback_registry.check())
+shutil.rmtree(fallback_dir)
+
+
 # In[]
 
 #  检验在线预测与事后预测结果是否一致
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# coding: utf-8
+# @Time : 2026/10/18 14:05
+# @Author : yangpingyan@gmail.com
+
+'''不依赖lightgbm的树模型预测
+
+export_tree_arrays把LightGBM模型(文本格式或Booster)展开成连续的NumPy数组,
+TreePredictor按LightGBM相同的判断规则和累加顺序计算得分, 结果与Booster.predict逐位一致。
+只支持二分类、数值型分裂的模型。
+'''
+
+import math
+import numpy as np
+
+# LightGBM中decision_type的位定义及零值阈值(kZeroThreshold为float类型的1e-35)
+kCategoricalMask = 1
+kDefaultLeftMask = 2
+kZeroThreshold = float(np.float32(1e-35))
+MISSING_NONE, MISSING_ZERO, MISSING_NAN = 0, 1, 2
+
+
+def _parse_model_str(model_str):
+    '''把LightGBM文本模型拆成头部和每棵树的键值字典'''
+    header = {}
+    trees = []
+    current = header
+    for line in model_str.splitlines():
+        line = line.strip()
+        if line.startswith('Tree='):
+            current = {}
+            trees.append(current)
+        elif line == 'end of trees':
+            break
+        elif '=' in line:
+            key, value = line.split('=', 1)
+            current[key] = value
+        elif len(line) > 0:
+            # average_output等标志只有名称
+            current[line] = ''
+    return header, trees
+
+
+def export_tree_arrays(model):
+    '''把模型展开成数组
+
+    节点编号是所有树统一的: 非负数为内部节点在split_feature等数组中的下标,
+    负数n为叶子节点, 叶子值为leaf_value[-n - 1]。
+    '''
+    model_str = model if isinstance(model, str) else model.model_to_string()
+    header, trees = _parse_model_str(model_str)
+    if int(header.get('num_tree_per_iteration', 1)) != 1:
+        raise ValueError("only binary/regression models are supported")
+    objective = header.get('objective', '').split()
+    sigmoid = None
+    if len(objective) > 0 and objective[0] == 'binary':
+        sigmoid = float(dict(x.split(':') for x in objective[1:]).get('sigmoid', 1.0))
+
+    split_feature, threshold, decision_type, left_child, right_child = [], [], [], [], []
+    leaf_value, tree_root = [], []
+    for tree in trees:
+        if int(tree.get('num_cat', 0)) > 0 or int(tree.get('is_linear', 0)) != 0:
+            raise ValueError("categorical splits and linear trees are not supported")
+        node_offset, leaf_offset = len(split_feature), len(leaf_value)
+        leaf_value.extend(float(x) for x in tree['leaf_value'].split())
+        if int(tree['num_leaves']) == 1:
+            tree_root.append(-leaf_offset - 1)
+            continue
+
+        def node_id(child):
+            return node_offset + child if child >= 0 else -(leaf_offset + ~child) - 1
+
+        split_feature.extend(int(x) for x in tree['split_feature'].split())
+        threshold.extend(float(x) for x in tree['threshold'].split())
+        decision_type.extend(int(x) for x in tree['decision_type'].split())
+        left_child.extend(node_id(int(x)) for x in tree['left_child'].split())
+        right_child.extend(node_id(int(x)) for x in tree['right_child'].split())
+        tree_root.append(node_offset)
+
+    decision_type = np.array(decision_type, dtype=np.int8)
+    return {'feature_names': np.array(header.get('feature_names', '').split()),
+            'split_feature': np.array(split_feature, dtype=np.int32),
+            'threshold': np.array(threshold, dtype=np.float64),
+            'default_left': (decision_type & kDefaultLeftMask) != 0,
+            'missing_type': ((decision_type >> 2) & 3).astype(np.int8),
+            'left_child': np.array(left_child, dtype=np.int32),
+            'right_child': np.array(right_child, dtype=np.int32),
+            'leaf_value': np.array(leaf_value, dtype=np.float64),
+            'tree_root': np.array(tree_root, dtype=np.int32),
+            'sigmoid': np.float64(np.nan if sigmoid is None else sigmoid),
+            'average_output': np.bool_('average_output' in header)}
+
+
+def save_tree_arrays(arrays, path):
+    np.savez(path, **arrays)
+
+
+def load_tree_arrays(path):
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+class TreePredictor(object):
+    '''用export_tree_arrays的数组预测, predict_row用于单行, predict用于多行'''
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.feature_names = arrays['feature_names'].tolist()
+        self.sigmoid = float(arrays['sigmoid'])
+        self.average_output = bool(arrays['average_output'])
+        self.num_trees = len(arrays['tree_root'])
+        # 单行预测逐个节点判断, python列表的下标访问比NumPy数组快
+        self._split_feature = arrays['split_feature'].tolist()
+        self._threshold = arrays['threshold'].tolist()
+        self._default_left = arrays['default_left'].tolist()
+        self._missing_type = arrays['missing_type'].tolist()
+        self._left_child = arrays['left_child'].tolist()
+        self._right_child = arrays['right_child'].tolist()
+        self._leaf_value = arrays['leaf_value'].tolist()
+        self._tree_root = arrays['tree_root'].tolist()
+
+    def _convert_output(self, raw):
+        if self.average_output:
+            raw = raw / self.num_trees
+        if math.isnan(self.sigmoid):
+            return raw
+        return 1.0 / (1.0 + math.exp(-self.sigmoid * raw))
+
+    def predict_row_raw(self, row):
+        '''单行原始得分, row为按feature_names顺序排列的特征值'''
+        x = [0.0 if -kZeroThreshold <= v <= kZeroThreshold else v for v in map(float, row)]
+        split_feature, threshold = self._split_feature, self._threshold
+        default_left, missing_type = self._default_left, self._missing_type
+        left_child, right_child = self._left_child, self._right_child
+        raw = 0.0
+        for node in self._tree_root:
+            while node >= 0:
+                fval = x[split_feature[node]]
+                mtype = missing_type[node]
+                if fval != fval and mtype != MISSING_NAN:
+                    fval = 0.0
+                if (mtype == MISSING_ZERO and -kZeroThreshold <= fval <= kZeroThreshold) or \
+                        (mtype == MISSING_NAN and fval != fval):
+                    node = left_child[node] if default_left[node] else right_child[node]
+                elif fval <= threshold[node]:
+                    node = left_child[node]
+                else:
+                    node = right_child[node]
+            raw += self._leaf_value[-node - 1]
+        return raw
+
+    def predict_row(self, row):
+        return self._convert_output(self.predict_row_raw(row))
+
+    def predict_raw(self, x):
+        '''多行原始得分, 所有行和所有树同时向下走一层'''
+        a = self.arrays
+        x = np.array(x, dtype=np.float64, ndmin=2)
+        x[np.abs(x) <= kZeroThreshold] = 0.0
+        n = x.shape[0]
+        node = np.tile(a['tree_root'], (n, 1))
+        rows = np.repeat(np.arange(n), self.num_trees).reshape(n, self.num_trees)
+        active = node >= 0
+        while active.any():
+            idx = node[active]
+            fval = x[rows[active], a['split_feature'][idx]]
+            mtype = a['missing_type'][idx]
+            is_nan = np.isnan(fval)
+            fval = np.where(is_nan & (mtype != MISSING_NAN), 0.0, fval)
+            use_default = ((mtype == MISSING_ZERO) & (np.abs(fval) <= kZeroThreshold)) | \
+                          ((mtype == MISSING_NAN) & is_nan)
+            go_left = np.where(use_default, a['default_left'][idx], fval <= a['threshold'][idx])
+            node[active] = np.where(go_left, a['left_child'][idx], a['right_child'][idx])
+            active = node >= 0
+        # 按树的顺序逐个累加, 与LightGBM的求和顺序一致
+        return np.cumsum(a['leaf_value'][-node - 1], axis=1)[:, -1] if self.num_trees > 0 else np.zeros(n)
+
+    def predict(self, x):
+        return np.array([self._convert_output(raw) for raw in self.predict_raw(x).tolist()], dtype=np.float64)
@@ -4,12 +4,18 @@
 # @Author : yangpingyan@gmail.com
 
 import pandas as pd
-import json
 import numpy as np
 import re
 import os
 import time
-from mibao_log import log
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from mibao_metrics import metrics
+from mibao_cache import TTLCache
+from mibao_concurrency import MicroBatcher
+from mibao_json import JsonColumn, iter_json_array
+from mibao_export import ExportState, export_tables
+from sqlalchemy import text, bindparam
 from sql import *
 from mltools import *
 import warnings
@@ -94,166 +100,209 @@ mibao_ml_features = ['merchant_id', 'pay_num', 'added_service',
                      ]
 
 
-def save_all_tables_mibao():
-    for table in sql_tables:
-        print(table)
-        feature_list = eval(table + '_features')
-        sql = "SELECT {} FROM `{}`;".format(",".join(feature_list), table)
-        df = read_sql_query(sql)
-        df.to_csv("{}.csv".format(os.path.join(workdir, table)), index=False)
+def save_all_tables_mibao(incremental=True, full_interval=7 * 24 * 3600, export_dir=workdir, workers=4):
+    '''把sql_tables导出为export_dir中的csv文件
+
+    incremental时每个表只读取上次导出后新增或修改的行并按主键更新csv, 每隔full_interval秒全量导出一次,
+    见export_table。workers个线程并发导出, 大表先开始, 见export_tables。
+    每个表的导出记录保存在export_dir中的export_state.json。
+    '''
+    state = ExportState(os.path.join(export_dir, 'export_state.json'))
+    tables = [(table, eval(table + '_features')) for table in sql_tables]
+    export_tables(sql_connection, tables, export_dir, state, workers, incremental=incremental,
+                  full_interval=full_interval)
 
     sql = '''SELECT table_name, column_name, DATA_TYPE, COLUMN_COMMENT FROM information_schema.columns; '''
     df = read_sql_query(sql)
     df.to_csv("mibao_comment.csv", index=False)
 
 
-def process_data_mibao(df):
+# 类别特征的取值, 按列表顺序编码为1, 2, 3..., 不在列表中的取值编码为0
+phone_list = ['130', '131', '132', '133', '134', '135', '136', '137', '138', '139', '147',
+              '150', '151', '152', '153', '155', '156', '157', '158', '159', '166', '170', '171',
+              '173', '175', '176', '177', '178', '180', '181', '182', '183', '184', '185', '186',
+              '187', '188', '189', '198', '199']
+type_list = ['DEPOSIT_ORDER', 'LEASE_ORDER', 'PCREDIT_FREEZE_ORDER', 'RELET_ORDER']
+source_list = ['aliPay', 'alipayMiniProgram', 'android', 'ios', 'jd', 'saas', 'weChat', 'weChatMiniProgram']
+merchant_store_id_list = [22.0, 36.0, 40.0, 42.0, 43.0, 45.0, 46.0, 47.0, 48.0, 49.0, 52.0, 53.0, 54.0,
+                          55.0, 56.0, 60.0, 62.0, 67.0, 70.0, 72.0, 73.0, 75.0, 76.0, 77.0, 81.0, 85.0, 131.0,
+                          137.0, 139.0, 140.0, 142.0, 144.0, 145.0, 146.0, 149.0, 151.0, 155.0, 161.0, 162.0, 168.0,
+                          170.0, 171.0, 172.0, 173.0, 176.0, 186.0, 196.0, 197.0, 199.0, 200.0, 201.0, 204.0, 207.0,
+                          209.0, 214.0, 450.0, 452.0, 453.0, 455.0, 464.0, 465.0, 467.0, 468.0, 470.0, 471.0, 472.0,
+                          473.0, 476.0, 478.0, 481.0, 482.0, 483.0, 485.0, 489.0, 491.0, 496.0, 19900002.0,
+                          47800001.0]
+device_type_list = ['OTHER', 'android', 'h5', 'ios', 'web']
+goods_type_list = ['VR眼睛', 'VR眼镜', '一体机', '健康监测', '光碟', '其他玩具', '其他生活电器', '剃须刀', '办公配件', '医疗健康', '厨房电器', '口腔护理',
+                   '台式电脑', '台球', '吸尘器/除螨器', '品质冰箱', '品质生活', '品质音响', '女神节专区', '安卓专区', '安卓手机', '平板', '平板电脑', '平衡车',
+                   '户外旅行', '手机', '手机配件', '手表', '打印机', '扫地机器人', '投影仪', '新人专区', '无人机', '无人飞机', '早教益智', '时尚手表', '时尚箱包',
+                   '时尚耳机', '显示器', '智力开发', '智能出行', '智能手表', '智能电视', '智能硬件', '洁面仪', '洗衣机', '洗衣神器', '游戏主机', '游戏光碟',
+                   '游戏电竞', '潮流相机', '灭蚊器', '爆款推荐', '玩具', '电动摩托车', '电动汽车', '电动车', '电吹风', '电子阅读', '电视机', '相机配件',
+                   '相机镜头', '积木王国', '移动硬盘', '空气净化器', '笔记本', '绿色出行', '美容仪', '翻译机', '耳机', '苹果专区', '苹果手机', '路由器',
+                   '运动器材', '酷乐玩具', '音乐播放器', '音响', '鼠标键盘']
+merchant_id_list = [22, 24, 32, 33, 34, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54,
+                    55, 56, 58, 59, 60, 61, 62, 63, 65, 67, 68, 70, 71, 72, 73, 74, 75, 76, 77, 81, 85, 131, 137,
+                    139, 140, 142, 144, 145, 146, 149, 150, 151, 155, 161, 162, 168, 170, 171, 172, 173, 176, 186,
+                    188, 192, 193, 195, 196, 197, 199, 200, 201, 204, 207, 209, 214, 274, 299, 414, 450, 452, 453,
+                    455, 457, 458, 459, 460, 461, 462, 463, 464, 465, 466, 467, 468, 470, 471, 472, 473, 476, 478,
+                    479, 481, 482, 483, 485, 489, 491, 496]
+order_type_list = ['COMMON', 'PUSHING']
+regist_channel_type_list = [0.0, 1.0, 2.0, 3.0, 4.0, 105.0, 112.0, 113.0, 117.0]
+occupational_identity_type_list = ['civil_servant', 'company_clerk', 'company_manager',
+                                   'enterprises_clerk', 'other', 'public_institution', 'teacher']
+ingress_type_list = ['APP', 'WEB']
+device_type_os_list = ['ANDROID', 'APPLE', 'OTHER', 'ios']
+bai_qi_shi_result_list = ['accept', 'reject', 'review']
+guanzhu_result_list = ['命中', '未命中']
+tongdun_result_list = ['pass', 'reject', 'review']
+delivery_way_list = ['PRIVATE_STORE', 'TO_DOOR_SERVICE']
+old_level_list = ['7成新', '8成新', '9成新', '二手', '全新', '非全新']
+category_list = ['个人护理', '休闲游戏', '优享电脑', '免租专区', '出行', '办公', '办公设备', '女神节专区', '家用电器', '家电', '影音娱乐', '手机', '数码',
+                 '新人专区', '时尚手机', '智能学习', '游戏', '潮流数码', '潮玩', '生活', '电脑', '益智玩具', '绿色出行', '运动户外', '高端奢侈']
+
+final_decision_list = ['拒绝', '通过', '需评估']
+
+features_cat = ['type', 'source', 'merchant_store_id',
+                'device_type', 'goods_type', 'merchant_id', 'order_type', 'regist_channel_type',
+                'occupational_identity_type', 'ingress_type', 'device_type_os',
+                'bai_qi_shi_result', 'guanzhu_result', 'tongdun_result', 'delivery_way', 'old_level', 'category',
+                'final_decision', 'phone']
+mibao_cat_vocabs = {feature: eval(feature + '_list') for feature in features_cat}
+# 只判断是否空值的特征
+features_cat_null = ['bounds_example_id', 'distance', 'fingerprint', 'added_service',
+                     'recommend_code', 'regist_device_info', 'company', 'company_phone', 'workplace',
+                     'idcard_pros', ]
+default_head_image_url = "headImg/20171126/ll15fap1o16y9zfr0ggl3g8xptgo80k9jbnp591d.png"
+
+
+# bai_qi_shi_detail_json是完整的报告, 只需要其中的最终得分, 用正则表达式查找比解析整个json快
+baiqishi_score_pattern = r'final\w+core.:[\'\"]?([\d]+)'
+
+
+def get_baiqishi_score(x):
+    ret = 0
+    if isinstance(x, type('str')):
+        ret_list = re.findall(baiqishi_score_pattern, x)
+        ret = int(ret_list[0]) if len(ret_list) > 0 else 0
+
+    return ret
+
+
+def get_score_value(x):
+    return float(x) if str(x) > '0' else 0
+
+
+def count_name_nums(data_list):
+    '''通讯录中不同的非数字姓名数, data_list可以是逐个解析联系人的迭代器'''
+    names = set()
+    for phone_book in data_list:
+        name = phone_book.get('name')
+        if len(name) > 0 and name.isdigit() is False:
+            names.add(name)
+
+    return len(names)
+
+
+# 从json列中取出的字段, 每个json字符串只解析一次
+order_detail_json = JsonColumn().add('xiaobaiScore', ('xiaobaiScore',), 0, get_score_value, np.float64) \
+    .add('zmxyScore', ('zmxyScore',), 0, get_score_value, np.float64)
+# 通讯录可能有几千个联系人, 逐个解析联系人计数, 内存中只保留不同的姓名
+phone_book_json = JsonColumn(iter_json_array).add('phone_book', None, 0, count_name_nums, np.int64)
+
+
+def text_values(series):
+    '''series中的字符串, 其它值为None, 结果总可以使用str方法(全为空值的float列不能使用)'''
+    return pd.Series([x if isinstance(x, str) else None for x in series.tolist()], index=series.index, dtype=object)
+
+
+def process_data_mibao(df, cat_vocabs=None):
+    # cat_vocabs: 类别特征的取值, 默认mibao_cat_vocabs, 线上预测时使用模型包中保存的取值
     # 取phone前3位
-    df['phone'][df['phone'].isnull()] = df['phone_user'][df['phone'].isnull()]
-    df['phone'].fillna(value='0', inplace=True)
-    df['phone'][df['phone'].str.len() != 11] = '0'
+    df['phone'] = df['phone'].fillna(df['phone_user'])
+    df['phone'] = df['phone'].fillna(value='0')
+    df['phone'] = df['phone'].mask(df['phone'].str.len() != 11, '0')
     df['phone'] = df['phone'].str.slice(0, 3)
 
-    phone_list = ['130', '131', '132', '133', '134', '135', '136', '137', '138', '139', '147',
-                  '150', '151', '152', '153', '155', '156', '157', '158', '159', '166', '170', '171',
-                  '173', '175', '176', '177', '178', '180', '181', '182', '183', '184', '185', '186',
-                  '187', '188', '189', '198', '199']
-    type_list = ['DEPOSIT_ORDER', 'LEASE_ORDER', 'PCREDIT_FREEZE_ORDER', 'RELET_ORDER']
-    source_list = ['aliPay', 'alipayMiniProgram', 'android', 'ios', 'jd', 'saas', 'weChat', 'weChatMiniProgram']
-    merchant_store_id_list = [22.0, 36.0, 40.0, 42.0, 43.0, 45.0, 46.0, 47.0, 48.0, 49.0, 52.0, 53.0, 54.0,
-                              55.0, 56.0, 60.0, 62.0, 67.0, 70.0, 72.0, 73.0, 75.0, 76.0, 77.0, 81.0, 85.0, 131.0,
-                              137.0, 139.0, 140.0, 142.0, 144.0, 145.0, 146.0, 149.0, 151.0, 155.0, 161.0, 162.0, 168.0,
-                              170.0, 171.0, 172.0, 173.0, 176.0, 186.0, 196.0, 197.0, 199.0, 200.0, 201.0, 204.0, 207.0,
-                              209.0, 214.0, 450.0, 452.0, 453.0, 455.0, 464.0, 465.0, 467.0, 468.0, 470.0, 471.0, 472.0,
-                              473.0, 476.0, 478.0, 481.0, 482.0, 483.0, 485.0, 489.0, 491.0, 496.0, 19900002.0,
-                              47800001.0]
-    device_type_list = ['OTHER', 'android', 'h5', 'ios', 'web']
-    goods_type_list = ['VR眼睛', 'VR眼镜', '一体机', '健康监测', '光碟', '其他玩具', '其他生活电器', '剃须刀', '办公配件', '医疗健康', '厨房电器', '口腔护理',
-                       '台式电脑', '台球', '吸尘器/除螨器', '品质冰箱', '品质生活', '品质音响', '女神节专区', '安卓专区', '安卓手机', '平板', '平板电脑', '平衡车',
-                       '户外旅行', '手机', '手机配件', '手表', '打印机', '扫地机器人', '投影仪', '新人专区', '无人机', '无人飞机', '早教益智', '时尚手表', '时尚箱包',
-                       '时尚耳机', '显示器', '智力开发', '智能出行', '智能手表', '智能电视', '智能硬件', '洁面仪', '洗衣机', '洗衣神器', '游戏主机', '游戏光碟',
-                       '游戏电竞', '潮流相机', '灭蚊器', '爆款推荐', '玩具', '电动摩托车', '电动汽车', '电动车', '电吹风', '电子阅读', '电视机', '相机配件',
-                       '相机镜头', '积木王国', '移动硬盘', '空气净化器', '笔记本', '绿色出行', '美容仪', '翻译机', '耳机', '苹果专区', '苹果手机', '路由器',
-                       '运动器材', '酷乐玩具', '音乐播放器', '音响', '鼠标键盘']
-    merchant_id_list = [22, 24, 32, 33, 34, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54,
-                        55, 56, 58, 59, 60, 61, 62, 63, 65, 67, 68, 70, 71, 72, 73, 74, 75, 76, 77, 81, 85, 131, 137,
-                        139, 140, 142, 144, 145, 146, 149, 150, 151, 155, 161, 162, 168, 170, 171, 172, 173, 176, 186,
-                        188, 192, 193, 195, 196, 197, 199, 200, 201, 204, 207, 209, 214, 274, 299, 414, 450, 452, 453,
-                        455, 457, 458, 459, 460, 461, 462, 463, 464, 465, 466, 467, 468, 470, 471, 472, 473, 476, 478,
-                        479, 481, 482, 483, 485, 489, 491, 496]
-    order_type_list = ['COMMON', 'PUSHING']
-    regist_channel_type_list = [0.0, 1.0, 2.0, 3.0, 4.0, 105.0, 112.0, 113.0, 117.0]
-    occupational_identity_type_list = ['civil_servant', 'company_clerk', 'company_manager',
-                                       'enterprises_clerk', 'other', 'public_institution', 'teacher']
-    ingress_type_list = ['APP', 'WEB']
-    device_type_os_list = ['ANDROID', 'APPLE', 'OTHER', 'ios']
-    bai_qi_shi_result_list = ['accept', 'reject', 'review']
-    guanzhu_result_list = ['命中', '未命中']
-    tongdun_result_list = ['pass', 'reject', 'review']
-    delivery_way_list = ['PRIVATE_STORE', 'TO_DOOR_SERVICE']
-    old_level_list = ['7成新', '8成新', '9成新', '二手', '全新', '非全新']
-    category_list = ['个人护理', '休闲游戏', '优享电脑', '免租专区', '出行', '办公', '办公设备', '女神节专区', '家用电器', '家电', '影音娱乐', '手机', '数码',
-                     '新人专区', '时尚手机', '智能学习', '游戏', '潮流数码', '潮玩', '生活', '电脑', '益智玩具', '绿色出行', '运动户外', '高端奢侈']
-
-    final_decision_list = ['拒绝', '通过', '需评估']
-
-    features_cat = ['type', 'source', 'merchant_store_id',
-                    'device_type', 'goods_type', 'merchant_id', 'order_type', 'regist_channel_type',
-                    'occupational_identity_type', 'ingress_type', 'device_type_os',
-                    'bai_qi_shi_result', 'guanzhu_result', 'tongdun_result', 'delivery_way', 'old_level', 'category',
-                    'final_decision', 'phone']
-
-    for feature in features_cat:
-        feature_list = eval(feature + '_list')
-        feature_dict = dict(zip(feature_list, range(1, len(feature_list) + 1)))
-        df[feature] = df[feature].map(lambda x: feature_dict.get(x, 0))
+    if cat_vocabs is None:
+        cat_vocabs = mibao_cat_vocabs
+    # 列表中的取值编码为1, 2, 3..., 其它为0
+    for feature, feature_list in cat_vocabs.items():
+        df[feature] = pd.Index(feature_list).get_indexer(df[feature]).astype('int64') + 1
 
     # 数据处理
-    df['xiaobaiScore'] = df['order_detail'].map(
-        lambda x: json.loads(x).get('xiaobaiScore', 0) if isinstance(x, str) else 0)
-    df['zmxyScore'] = df['order_detail'].map(lambda x: json.loads(x).get('zmxyScore', 0) if isinstance(x, str) else '0')
-    df['xiaobaiScore'] = df['xiaobaiScore'].map(lambda x: float(x) if str(x) > '0' else 0)
-    df['zmxyScore'] = df['zmxyScore'].map(lambda x: float(x) if str(x) > '0' else 0)
+    scores = order_detail_json.extract(df['order_detail'].tolist())
+    df['xiaobaiScore'] = scores['xiaobaiScore']
+    df['zmxyScore'] = scores['zmxyScore']
 
     # 只判断是否空值的特征处理
-    features_cat_null = ['bounds_example_id', 'distance', 'fingerprint', 'added_service',
-                         'recommend_code', 'regist_device_info', 'company', 'company_phone', 'workplace',
-                         'idcard_pros', ]
     for feature in features_cat_null:
-        df[feature].fillna(0, inplace=True)
+        df[feature] = df[feature].fillna(0)
         df[feature] = np.where(df[feature].isin(['', ' ', 0]), 0, 1)
 
     df['deposit'] = np.where(df['deposit'] == 0, 0, 1)
 
-    df['head_image_url'].fillna(value=0, inplace=True)
-    df['head_image_url'] = df['head_image_url'].map(
-        lambda x: 0 if x == ("headImg/20171126/ll15fap1o16y9zfr0ggl3g8xptgo80k9jbnp591d.png") or x == 0 else 1)
+    df['head_image_url'] = df['head_image_url'].fillna(value=0)
+    df['head_image_url'] = np.where(df['head_image_url'].isin([default_head_image_url, 0]), 0, 1)
 
     df['share_callback'] = np.where(df['share_callback'] < 1, 0, 1)
-    df['tag'] = np.where(df['tag'].str.match('new'), 1, 0)
-    df['account_num'].fillna(value=0, inplace=True)
-    df['final_score'].fillna(value=0, inplace=True)
+    df['tag'] = np.where(df['tag'].str.match('new', na=True), 1, 0)
+    df['account_num'] = df['account_num'].fillna(value=0)
+    df['final_score'] = df['final_score'].fillna(value=0)
 
-    df['cert_no'][df['cert_no'].isnull()] = df['card_id'][df['cert_no'].isnull()]
+    df['cert_no'] = df['cert_no'].fillna(df['card_id'])
     # 有45个身份证号缺失但审核通过的订单， 舍弃不要。
     df = df[df['cert_no'].notnull()]
 
     # 处理芝麻信用分 '>600' 更改成600
-    df['zmxy_score'][df['zmxy_score'].isin(['', ' '])] = 0
-    zmf = [0.0] * len(df)
-    xbf = [0.0] * len(df)
-    for row, detail in enumerate(df['zmxy_score'].tolist()):
-        # print(row, detail)
-        if isinstance(detail, type('hh')):
-            if '/' in detail:
-                score = detail.split('/')
-                xbf[row] = 0 if score[0] == '' else (float(score[0]))
-                zmf[row] = 0 if score[1] == '' else (float(score[1]))
-            # print(score, row)
-            elif '>' in detail:
-                zmf[row] = 600
-            else:
-                score = float(detail)
-                if score <= 200:
-                    xbf[row] = score
-                else:
-                    zmf[row] = score
-
-    df['zmf'] = zmf
-    df['xbf'] = xbf
-
-    df['zmf'][df['zmf'] == 0] = df['zmxyScore'][df['zmf'] == 0].astype(float)  # 26623
-    df['xbf'][df['xbf'] == 0] = df['xiaobaiScore'][df['xbf'] == 0].astype(float)  # 26623
-    df['zmf'].fillna(value=0, inplace=True)
-    df['xbf'].fillna(value=0, inplace=True)
+    df['zmxy_score'] = df['zmxy_score'].mask(df['zmxy_score'].isin(['', ' ']), 0)
+    # 'xbf/zmf'分别为小白分和芝麻分, 含'>'的为600, 其它数值不超过200的为小白分, 否则为芝麻分
+    detail = text_values(df['zmxy_score'])
+    zmf = np.zeros(len(df))
+    xbf = np.zeros(len(df))
+    is_pair = detail.str.contains('/', regex=False, na=False).values
+    is_gt = ~is_pair & detail.str.contains('>', regex=False, na=False).values
+    is_score = detail.notnull().values & ~is_pair & ~is_gt
+    # 600及空字符串的0为整数, 与逐行计算相同, 所有值都是整数时列为int64
+    zmf_is_int = is_gt.copy()
+    xbf_is_int = np.zeros(len(df), dtype=bool)
+    if is_pair.any():
+        score = detail[is_pair].str.split('/')
+        xbf_is_int[is_pair] = (score.str[0] == '').values
+        zmf_is_int[is_pair] = (score.str[1] == '').values
+        xbf[is_pair] = score.str[0].replace('', '0').astype(float).values
+        zmf[is_pair] = score.str[1].replace('', '0').astype(float).values
+    zmf[is_gt] = 600
+    score = detail[is_score].astype(float).values
+    xbf[is_score] = np.where(score <= 200, score, 0)
+    zmf[is_score] = np.where(score <= 200, 0, score)
+
+    df['zmf'] = zmf.astype('int64') if len(df) > 0 and zmf_is_int.all() else zmf
+    df['xbf'] = xbf.astype('int64') if len(df) > 0 and xbf_is_int.all() else xbf
+
+    df['zmf'] = df['zmf'].mask(df['zmf'] == 0, df['zmxyScore'].astype(float))  # 26623
+    df['xbf'] = df['xbf'].mask(df['xbf'] == 0, df['xiaobaiScore'].astype(float))  # 26623
+    df['zmf'] = df['zmf'].fillna(value=0)
+    df['xbf'] = df['xbf'].fillna(value=0)
     # zmf_most = df['zmf'][df['zmf'] > 0].value_counts().index[0]
     # xbf_most = df['xbf'][df['xbf'] > 0].value_counts().index[0]
-    df['zmf'][df['zmf'] == 0] = 600  # zmf_most
-    df['xbf'][df['xbf'] == 0] = 87.6  # xbf_most
+    df['zmf'] = df['zmf'].mask(df['zmf'] == 0, 600)  # zmf_most
+    df['xbf'] = df['xbf'].mask(df['xbf'] == 0, 87.6)  # xbf_most
 
     # order_id =9085, 9098的crate_time 是错误的
     df = df[df['create_time'] > '2016']
     # 把createtime分成月周日小时
     df['create_time'] = pd.to_datetime(df['create_time'])
-    df['year'] = df['create_time'].map(lambda x: x.year)
-    # df['month'] = df['create_time'].map(lambda x: x.month)
-    df['day'] = df['create_time'].map(lambda x: x.day)
-    df['weekday'] = df['create_time'].map(lambda x: x.weekday())
-    df['hour'] = df['create_time'].map(lambda x: x.hour)
+    df['year'] = df['create_time'].dt.year.astype('int64')
+    # df['month'] = df['create_time'].dt.month.astype('int64')
+    df['day'] = df['create_time'].dt.day.astype('int64')
+    df['weekday'] = df['create_time'].dt.weekday.astype('int64')
+    df['hour'] = df['create_time'].dt.hour.astype('int64')
 
     # 根据身份证号增加性别和年龄 年龄的计算需根据订单创建日期计算
     df['age'] = df['year'] - df['cert_no'].str.slice(6, 10).astype(int)
     df['sex'] = df['cert_no'].str.slice(-2, -1).astype(int) % 2
 
-    def get_baiqishi_score(x):
-        ret = 0
-        if isinstance(x, type('str')):
-            ret_list = re.findall(r'final\w+core.:[\'\"]?([\d]+)', x)
-            ret = int(ret_list[0]) if len(ret_list) > 0 else 0
-
-        return ret
-
-    df['baiqishi_score'] = df['bai_qi_shi_detail_json'].map(lambda x: get_baiqishi_score(x))
+    df['baiqishi_score'] = text_values(df['bai_qi_shi_detail_json']).str.extract(
+        baiqishi_score_pattern, expand=False).fillna(0).astype('int64')
 
     #
     # # 处理mibao_detail_json
@@ -304,12 +353,183 @@ def process_data_mibao(df):
     return df
 
 
+def is_null(x):
+    return x is None or x is pd.NaT or (isinstance(x, float) and x != x)
+
+
+min_create_time = pd.Timestamp('2016')
+cat_codes_cache = {}
+
+
+def get_cat_codes(cat_vocabs):
+    '''类别特征取值到编码的字典, 与process_data_mibao的编码相同, 按cat_vocabs对象缓存'''
+    item = cat_codes_cache.get(id(cat_vocabs))
+    if item is None or item[0] is not cat_vocabs:
+        codes = {feature: dict(zip(feature_list, range(1, len(feature_list) + 1)))
+                 for feature, feature_list in cat_vocabs.items()}
+        item = cat_codes_cache[id(cat_vocabs)] = (cat_vocabs, codes)
+    return item[1]
+
+
+def process_order_row(row, cat_codes, features=mibao_ml_features):
+    '''process_data_mibao的单行版本
+
+    row为merge_order_data结果中的一行(列名到值的字典), cat_codes为get_cat_codes的结果。
+    返回按features排列的特征值列表, 该行会被process_data_mibao删除时返回None。
+    修改process_data_mibao时需同步修改这里, mibao_test.py中有两者的一致性测试。
+    '''
+    cert_no = row['cert_no']
+    if is_null(cert_no):
+        cert_no = row['card_id']
+        if is_null(cert_no):
+            return None
+    create_time = row['create_time']
+    if isinstance(create_time, str):
+        if not create_time > '2016':
+            return None
+        create_time = pd.Timestamp(create_time)
+    elif not pd.Timestamp(create_time) > min_create_time:
+        return None
+
+    values = dict(row)
+    phone = row['phone']
+    if is_null(phone):
+        phone = row['phone_user']
+    if not isinstance(phone, str) or len(phone) != 11:
+        phone = '0'
+    values['phone'] = phone[:3]
+    for feature, feature_dict in cat_codes.items():
+        values[feature] = feature_dict.get(values[feature], 0)
+
+    xiaobai_score, zmxy_score = order_detail_json.extract_row(values['order_detail'])
+
+    for feature in features_cat_null:
+        x = values[feature]
+        values[feature] = 0 if is_null(x) or x in ('', ' ', 0) else 1
+    x = values['head_image_url']
+    values['head_image_url'] = 0 if is_null(x) or x == default_head_image_url or x == 0 else 1
+    x = values['share_callback']
+    values['share_callback'] = 0 if not is_null(x) and x < 1 else 1
+    # 空值及非字符串取1, 与str.match('new', na=True)相同
+    x = values['tag']
+    values['tag'] = 0 if isinstance(x, str) and not x.startswith('new') else 1
+    if is_null(values['final_score']):
+        values['final_score'] = 0
+
+    zmf = xbf = 0.0
+    detail = values['zmxy_score']
+    if isinstance(detail, str) and detail not in ('', ' '):
+        if '/' in detail:
+            score = detail.split('/')
+            xbf = 0 if score[0] == '' else float(score[0])
+            zmf = 0 if score[1] == '' else float(score[1])
+        elif '>' in detail:
+            zmf = 600
+        else:
+            score = float(detail)
+            if score <= 200:
+                xbf = score
+            else:
+                zmf = score
+    if zmf == 0:
+        zmf = zmxy_score
+    if xbf == 0:
+        xbf = xiaobai_score
+    values['zmf'] = 600 if is_null(zmf) or zmf == 0 else zmf
+    values['xbf'] = 87.6 if is_null(xbf) or xbf == 0 else xbf
+
+    values['weekday'] = create_time.weekday()
+    values['hour'] = create_time.hour
+    values['age'] = create_time.year - int(cert_no[6:10])
+    values['sex'] = int(cert_no[-2:-1]) % 2
+    values['baiqishi_score'] = get_baiqishi_score(values['bai_qi_shi_detail_json'])
+    return [values[feature] for feature in features]
+
+
+def process_order_features(df, cat_vocabs=None, features=mibao_ml_features):
+    '''单个订单的特征, 结果与process_data_mibao(df, cat_vocabs)[features]的第一行相同
+
+    df为merge_order_data的结果, 逐行处理直到第一行未被删除的数据, 避免整表操作的开销。
+    返回(1, len(features))的数组, 所有行都被删除时返回None。
+    '''
+    cat_codes = get_cat_codes(mibao_cat_vocabs if cat_vocabs is None else cat_vocabs)
+    columns = df.columns.tolist()
+    # 通常第一行就是结果, 逐行取值比to_dict('records')等整表转换快很多
+    for i in range(len(df)):
+        values = process_order_row(dict(zip(columns, df.iloc[i].tolist())), cat_codes, features)
+        if values is not None:
+            return np.array([values], dtype=np.float64)
+    return None
+
+
+def sql_param(value):
+    '''转换为数据库驱动能转义的python类型, numpy数值转为python数值, NaN转为None'''
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+# 参数化查询语句, 每种(表名, 字段, 查询字段)只生成一次, 之后每次查询只绑定参数
+statement_cache = {}
+
+
+def get_statement(filename, features, table, many=False):
+    '''查询filename表中table字段等于:id_value的行, many为True时:id_value为列表'''
+    key = (filename, tuple(features), table, many)
+    statement = statement_cache.get(key)
+    if statement is None:
+        if many:
+            statement = text("SELECT {} FROM `{}` o WHERE o.{} IN :id_value".format(",".join(features), filename,
+                                                                                   table))
+            statement = statement.bindparams(bindparam('id_value', expanding=True))
+        else:
+            statement = text("SELECT {} FROM `{}` o WHERE o.{} = :id_value".format(",".join(features), filename,
+                                                                                  table))
+        statement_cache[key] = statement
+    return statement
+
+
+# 按user_id读取的表的缓存时间(秒), 同一用户的多个订单不再重复查询这些表
+user_cache_ttls = {'user': 600, 'bargain_help': 300, 'face_id': 300, 'user_credit': 3600, 'user_device': 3600,
+                   'user_third_party_account': 600, 'user_zhima_cert': 600}
+user_feature_cache = TTLCache(maxsize=50000, ttl=600)
+# 查询结果为空(如用户数据还没有写入)时只缓存这么多秒, 不使用上面的缓存时间
+user_cache_negative_ttl = 30
+
+
+def cache_user_table(table, features, id_value, df):
+    '''缓存按user_id读取的表的副本, 空结果使用较短的user_cache_negative_ttl'''
+    ttl = user_cache_ttls[table] if len(df) > 0 else user_cache_negative_ttl
+    user_feature_cache.set((table, tuple(features), id_value), df.copy(), ttl=ttl)
+
+
+def invalidate_user_cache(user_id, tables=None):
+    '''用户数据变化时删除该用户的缓存, tables默认为所有按user_id缓存的表, 返回删除的条目数'''
+    tables = user_cache_ttls.keys() if tables is None else tables
+    return user_feature_cache.delete_if(lambda key: key[2] == user_id and key[0] in tables)
+
+
 def read_mlfile(filename, features, table='order_id', id_value=None, is_sql=False):
     # starttime = time.clock()
-    if is_sql:
-        sql = "SELECT {} FROM `{}` o WHERE o.{} = {};".format(",".join(features), filename, table, id_value)
-        # print(sql)
-        df = read_sql_query(sql)
+    # id_value为列表时用IN查询多个值
+    if is_sql and isinstance(id_value, (list, tuple, set, np.ndarray, pd.Series)):
+        statement = get_statement(filename, features, table, many=True)
+        with metrics.timer('mibao_table_fetch_seconds', table=filename):
+            df = read_sql_query(statement, {'id_value': [sql_param(x) for x in id_value]})
+    elif is_sql:
+        # 调用方会修改返回的DataFrame, 缓存中保存副本
+        cache_key = (filename, tuple(features), id_value)
+        if filename in user_cache_ttls:
+            df = user_feature_cache.get(cache_key)
+            if df is not None:
+                return df.copy()
+        statement = get_statement(filename, features, table)
+        with metrics.timer('mibao_table_fetch_seconds', table=filename):
+            df = read_sql_query(statement, {'id_value': sql_param(id_value)})
+        if filename in user_cache_ttls:
+            cache_user_table(filename, features, id_value, df)
     else:
         df = pd.read_csv(os.path.join(workdir, 'datasets', filename + '.csv'), encoding='utf-8', engine='python')
         df = df[features]
@@ -317,83 +537,264 @@ def read_mlfile(filename, features, table='order_id', id_value=None, is_sql=Fals
     return df
 
 
-def get_order_data(order_id=88668, is_sql=False):
+# get_order_data 需要读取的表: (表名, 字段, 查询字段, 关联键)
+# 关联键 order_id/user_id/order_number 均取自order表
+order_data_tables = [
+    ('user', user_features, 'id', 'user_id'),
+    ('bargain_help', bargain_help_features, 'user_id', 'user_id'),
+    ('face_id', face_id_features, 'user_id', 'user_id'),
+    ('face_id_liveness', face_id_liveness_features, 'order_id', 'order_id'),
+    ('user_credit', user_credit_features, 'user_id', 'user_id'),
+    ('user_device', user_device_features, 'user_id', 'user_id'),
+    ('order_express', order_express_features, 'order_id', 'order_id'),
+    ('order_detail', order_detail_features, 'order_id', 'order_id'),
+    ('order_goods', order_goods_features, 'order_id', 'order_id'),
+    ('order_phone_book', order_phone_book_features, 'order_id', 'order_id'),
+    ('risk_order', risk_order_features, 'order_id', 'order_id'),
+    ('tongdun', tongdun_features, 'order_number', 'order_number'),
+    ('user_third_party_account', user_third_party_account_features, 'user_id', 'user_id'),
+    ('user_zhima_cert', user_zhima_cert_features, 'user_id', 'user_id'),
+    ('jimi_order_check_result', jimi_order_check_result_features, 'order_id', 'order_id'),
+    ('credit_audit_order', credit_audit_order_features, 'order_id', 'order_id'),
+]
+
+
+# 并发读取表时的最大线程数，所有请求共用一个线程池，同时也限制了数据库的并发查询数
+order_fetch_workers = 8
+order_fetch_pool = None
+order_fetch_pool_lock = threading.Lock()
+
+
+def get_order_fetch_pool():
+    '''获取并发读取表用的线程池，第一次使用时创建'''
+    global order_fetch_pool
+    with order_fetch_pool_lock:
+        if order_fetch_pool is None:
+            order_fetch_pool = ThreadPoolExecutor(max_workers=order_fetch_workers, thread_name_prefix='order_fetch')
+    return order_fetch_pool
+
+
+def read_order_tables(order_id, user_id, order_number, is_sql=False, concurrent=False):
+    '''读取get_order_data需要的数据, concurrent为True时各表同时查询'''
+    key_values = {'order_id': order_id, 'user_id': user_id, 'order_number': order_number}
+    tables = {}
+    if concurrent:
+        pool = get_order_fetch_pool()
+        futures = [(table, pool.submit(read_mlfile, table, features, column, key_values[key], is_sql))
+                   for table, features, column, key in order_data_tables]
+        for table, future in futures:
+            tables[table] = future.result()
+    else:
+        for table, features, column, key in order_data_tables:
+            tables[table] = read_mlfile(table, features, column, key_values[key], is_sql)
+    return tables
+
+
+def get_order_tables_joined_sqls(tables=order_data_tables, with_order=True):
+    '''read_order_tables_joined的语句, 每种表的组合只生成一次
+
+    with_order时先查询order表, 订单号用%(order_id)s参数绑定; 否则不查询order表, user_id和order_number
+    也用%(user_id)s, %(order_number)s参数绑定
+    '''
+    cache_key = ('joined', tuple(table for table, _, _, _ in tables), with_order)
+    sqls = statement_cache.get(cache_key)
+    if sqls is None:
+        if with_order:
+            # user_id, order_number用子查询从order表取得，不必等order表的查询结果
+            key_sqls = {'order_id': "%(order_id)s",
+                        'user_id': "(SELECT user_id FROM `order` WHERE id = %(order_id)s)",
+                        'order_number': "(SELECT order_number FROM `order` WHERE id = %(order_id)s)"}
+            sqls = ["SELECT {} FROM `order` o WHERE o.id = %(order_id)s;".format(",".join(order_features))]
+        else:
+            key_sqls = {key: "%({})s".format(key) for key in ['order_id', 'user_id', 'order_number']}
+            sqls = []
+        for table, features, column, key in tables:
+            sqls.append(
+                "SELECT {} FROM `{}` o WHERE o.{} = {};".format(",".join(features), table, column, key_sqls[key]))
+        statement_cache[cache_key] = sqls
+    return sqls
+
+
+def read_order_tables_joined(order_id):
+    '''一次数据库往返读取order表和get_order_data需要的表
+
+    按user_id缓存的表(user_cache_ttls)不在这次往返中读取, 先从缓存中取, 缓存中没有的表再一次往返读取并缓存
+    '''
+    joined_tables = [x for x in order_data_tables if x[0] not in user_cache_ttls]
+    cached_tables = [x for x in order_data_tables if x[0] in user_cache_ttls]
+    with metrics.timer('mibao_table_fetch_seconds', table='joined'):
+        dfs = read_sql_queries(get_order_tables_joined_sqls(joined_tables), {'order_id': sql_param(order_id)})
+    order_df = dfs[0]
+    tables = {table: df for (table, _, _, _), df in zip(joined_tables, dfs[1:])}
+    if len(order_df) == 0 or len(cached_tables) == 0:
+        return order_df, tables
+
+    key_values = {'order_id': order_id, 'user_id': order_df.at[0, 'user_id'],
+                  'order_number': order_df.at[0, 'order_number']}
+    missing_tables = []
+    for table, features, column, key in cached_tables:
+        # 与read_mlfile使用相同的缓存key, 各种读取方式共用缓存
+        df = user_feature_cache.get((table, tuple(features), key_values[key]))
+        if df is None:
+            missing_tables.append((table, features, column, key))
+        else:
+            tables[table] = df.copy()
+    if len(missing_tables) > 0:
+        with metrics.timer('mibao_table_fetch_seconds', table='joined_user'):
+            dfs = read_sql_queries(get_order_tables_joined_sqls(missing_tables, with_order=False),
+                                   {key: sql_param(value) for key, value in key_values.items()})
+        for (table, features, column, key), df in zip(missing_tables, dfs):
+            cache_user_table(table, features, key_values[key], df)
+            tables[table] = df
+    return order_df, tables
+
+
+def read_table_batch(items):
+    '''items为(表名, 字段, 查询字段, 值)的列表, 返回每个item查询到的行
+
+    同一表的值合并成一条IN查询, 所有表的查询一次数据库往返完成
+    '''
+    groups = {}
+    for table, features, column, value in items:
+        groups.setdefault((table, tuple(features), column), set()).add(sql_param(value))
+    keys = list(groups)
+    sqls = []
+    params = {}
+    for i, (table, features, column) in enumerate(keys):
+        sqls.append("SELECT {} FROM `{}` o WHERE o.{} IN %(values{})s;".format(",".join(features), table, column, i))
+        params['values{}'.format(i)] = tuple(groups[(table, features, column)])
+    with metrics.timer('mibao_table_fetch_seconds', table='batched'):
+        query_rows = read_sql_queries_rows(sqls, params)
+    # 按查询字段的值分组原始行, 每个item单独构造DataFrame, 数据类型与单独查询时相同,
+    # 不受同一批其它值的行(如NULL使整数列变为浮点数)影响
+    value_rows = {}
+    for key, (columns, rows) in zip(keys, query_rows):
+        groups = value_rows[key] = (columns, {})
+        index = columns.index(key[2])
+        for row in rows:
+            groups[1].setdefault(row[index], []).append(row)
+    results = []
+    for table, features, column, value in items:
+        columns, groups = value_rows[(table, tuple(features), column)]
+        results.append(pd.DataFrame.from_records(groups.get(sql_param(value), []), columns=columns,
+                                                 coerce_float=True))
+    return results
+
+
+# 合并并发请求的表查询: 最多等待max_wait秒, 期间各请求对同一表的查询合并成一条IN查询
+table_loader = MicroBatcher(read_table_batch, max_batch=1024, max_wait=0.002, name='table_lookup')
+
+
+def read_order_tables_batched(order_id):
+    '''与其它请求合并查询, 先读取order表, 再读取其余各表, 每步一次数据库往返'''
+    order_df = table_loader.submit(('order', order_features, 'id', order_id))
+    if len(order_df) == 0:
+        return order_df, None
+    key_values = {'order_id': order_id, 'user_id': order_df.at[0, 'user_id'],
+                  'order_number': order_df.at[0, 'order_number']}
+    dfs = table_loader.submit_many([(table, features, column, key_values[key])
+                                    for table, features, column, key in order_data_tables])
+    return order_df, {table: df for (table, _, _, _), df in zip(order_data_tables, dfs)}
+
+
+def get_order_data(order_id=88668, is_sql=False, fetch_mode='serial'):
+    # fetch_mode仅在is_sql时有效: 'serial' 逐表查询, 'joined' 一次往返查询所有表,
+    # 'concurrent' 读取order表后其余各表同时查询, 'batched' 与并发的其它请求合并查询
     # 读取order表
     # log.debug("get_oder_data")
-    order_df = read_mlfile('order', order_features, 'id', order_id, is_sql)
+    tables = None
+    if is_sql and fetch_mode == 'joined':
+        order_df, tables = read_order_tables_joined(order_id)
+    elif is_sql and fetch_mode == 'batched':
+        order_df, tables = read_order_tables_batched(order_id)
+    else:
+        order_df = read_mlfile('order', order_features, 'id', order_id, is_sql)
 
     if len(order_df) == 0:
         return order_df
     order_df.rename(columns={'id': 'order_id'}, inplace=True)
-    user_id = order_df.at[0, 'user_id']
-    order_number = order_df.at[0, 'order_number']
+    if tables is None:
+        user_id = order_df.at[0, 'user_id']
+        order_number = order_df.at[0, 'order_number']
+        tables = read_order_tables(order_id, user_id, order_number, is_sql,
+                                   concurrent=is_sql and fetch_mode == 'concurrent')
+
+    return merge_order_data(order_df, tables)
+
+
+def get_orders_data(order_ids, is_sql=True):
+    '''批量读取多个订单的数据, 每个表只查询一次, 返回与get_order_data相同格式的合并数据'''
+    order_df = read_mlfile('order', order_features, 'id', list(order_ids), is_sql)
+    if len(order_df) == 0:
+        return order_df
+    order_df.rename(columns={'id': 'order_id'}, inplace=True)
+    key_values = {'order_id': order_df['order_id'].unique().tolist(),
+                  'user_id': order_df['user_id'].dropna().unique().tolist(),
+                  'order_number': order_df['order_number'].dropna().unique().tolist()}
+    tables = {}
+    for table, features, column, key in order_data_tables:
+        tables[table] = read_mlfile(table, features, column, key_values[key], is_sql)
+
+    return merge_order_data(order_df, tables)
+
+
+def merge_order_data(order_df, tables):
+    '''把各表数据处理后合并到order表, tables为表名到DataFrame的字典'''
     all_data_df = order_df.copy()
     order_df.sort_values('distance', inplace=True)
 
     # 读取并处理表 user
-    user_df = read_mlfile('user', user_features, 'id', user_id, is_sql)
+    user_df = tables['user']
     user_df.rename(columns={'id': 'user_id', 'phone': 'phone_user'}, inplace=True)
     all_data_df = pd.merge(all_data_df, user_df, on='user_id', how='left')
 
     # 读取并处理表 bargain_help
-    bargain_help_df = read_mlfile('bargain_help', bargain_help_features, 'user_id', user_id, is_sql)
+    bargain_help_df = tables['bargain_help']
     all_data_df['have_bargain_help'] = np.where(all_data_df['user_id'].isin(bargain_help_df['user_id'].values), 1, 0)
 
     # 读取并处理表 face_id
-    face_id_df = read_mlfile('face_id', face_id_features, 'user_id', user_id, is_sql)
+    face_id_df = tables['face_id']
     face_id_df.rename(columns={'status': 'face_check'}, inplace=True)
     all_data_df = pd.merge(all_data_df, face_id_df, on='user_id', how='left')
 
     # 读取并处理表 face_id_liveness
-    face_id_liveness_df = read_mlfile('face_id_liveness', ['order_id', 'status'], 'order_id', order_id, is_sql)
+    face_id_liveness_df = tables['face_id_liveness']
     face_id_liveness_df.rename(columns={'status': 'face_live_check'}, inplace=True)
     all_data_df = pd.merge(all_data_df, face_id_liveness_df, on='order_id', how='left')
 
     # 读取并处理表 user_credit
-    user_credit_df = read_mlfile('user_credit', user_credit_features, 'user_id', user_id, is_sql)
+    user_credit_df = tables['user_credit']
     all_data_df = pd.merge(all_data_df, user_credit_df, on='user_id', how='left')
 
     # 读取并处理表 user_device
-    user_device_df = read_mlfile('user_device', user_device_features, 'user_id', user_id, is_sql)
+    user_device_df = tables['user_device']
     user_device_df.rename(columns={'device_type': 'device_type_os'}, inplace=True)
     all_data_df = pd.merge(all_data_df, user_device_df, on='user_id', how='left')
 
     # 读取并处理表 order_express
     # 未处理特征：'country', 'provice', 'city', 'regoin', 'receive_address', 'live_address'
-    order_express_df = read_mlfile('order_express', order_express_features, 'order_id', order_id, is_sql)
+    order_express_df = tables['order_express']
     order_express_df.drop_duplicates(subset='order_id', inplace=True)
     all_data_df = pd.merge(all_data_df, order_express_df, on='order_id', how='left')
 
     # 读取并处理表 order_detail
-    order_detail_df = read_mlfile('order_detail', order_detail_features, 'order_id', order_id, is_sql)
+    order_detail_df = tables['order_detail']
     all_data_df = pd.merge(all_data_df, order_detail_df, on='order_id', how='left')
 
     # 读取并处理表 order_goods
-    order_goods_df = read_mlfile('order_goods', order_goods_features, 'order_id', order_id,
-                                 is_sql)
+    order_goods_df = tables['order_goods']
     order_goods_df.drop_duplicates(subset='order_id', inplace=True)
     all_data_df = pd.merge(all_data_df, order_goods_df, on='order_id', how='left')
 
     # 读取并处理表 order_phone_book
-    def count_name_nums(data):
-        name_list = []
-        if isinstance(data, str):
-            data_list = json.loads(data)
-            for phone_book in data_list:
-                if len(phone_book.get('name')) > 0 and phone_book.get('name').isdigit() is False:
-                    name_list.append(phone_book.get('name'))
-
-        return len(set(name_list))
-
-    order_phone_book_df = read_mlfile('order_phone_book', ['order_id', 'phone_book'], 'order_id', order_id, is_sql)
-    order_phone_book_df['phone_book'] = order_phone_book_df['phone_book'].map(count_name_nums)
+    order_phone_book_df = tables['order_phone_book']
+    order_phone_book_df['phone_book'] = phone_book_json.extract(order_phone_book_df['phone_book'].tolist())['phone_book']
 
     all_data_df = pd.merge(all_data_df, order_phone_book_df, on='order_id', how='left')
-    all_data_df['phone_book'].fillna(value=0, inplace=True)
+    all_data_df['phone_book'] = all_data_df['phone_book'].fillna(value=0)
 
     # 读取并处理表 risk_order
-    risk_order_df = read_mlfile('risk_order', risk_order_features, 'order_id', order_id,
-                                is_sql)
+    risk_order_df = tables['risk_order']
     risk_order_df['result'] = risk_order_df['result'].str.lower()
     for risk_type in ['tongdun', 'mibao', 'guanzhu', 'bai_qi_shi']:
         tmp_df = risk_order_df[risk_order_df['type'].str.match(risk_type)][
@@ -404,26 +805,25 @@ def get_order_data(order_id=88668, is_sql=False):
             inplace=True)
         all_data_df = pd.merge(all_data_df, tmp_df, on='order_id', how='left')
     # 读取并处理表 tongdun
-    tongdun_df = read_mlfile('tongdun', tongdun_features, 'order_number', order_number,
-                             is_sql)
+    tongdun_df = tables['tongdun']
     all_data_df = pd.merge(all_data_df, tongdun_df, on='order_number', how='left')
 
     # 读取并处理表 user_third_party_account
-    user_third_party_account_df = read_mlfile('user_third_party_account', ['user_id'], 'user_id', user_id, is_sql)
-    counts_df = pd.DataFrame({'account_num': user_third_party_account_df['user_id'].value_counts()})
-    counts_df['user_id'] = counts_df.index
+    user_third_party_account_df = tables['user_third_party_account']
+    counts = user_third_party_account_df['user_id'].value_counts()
+    counts_df = pd.DataFrame({'user_id': counts.index.values, 'account_num': counts.values})
     all_data_df = pd.merge(all_data_df, counts_df, on='user_id', how='left')
 
     # 读取并处理表 user_zhima_cert
-    df = read_mlfile('user_zhima_cert', user_zhima_cert_features, 'user_id', user_id, is_sql)
+    df = tables['user_zhima_cert']
     all_data_df['zhima_cert_result'] = np.where(all_data_df['user_id'].isin(df['user_id'].tolist()), 1, 0)
 
     # 读取并处理表 jimi_order_check_result
-    df = read_mlfile('jimi_order_check_result', jimi_order_check_result_features, 'order_id', order_id, is_sql)
+    df = tables['jimi_order_check_result']
     all_data_df = pd.merge(all_data_df, df, on='order_id', how='left')
 
     # 读取并处理表 credit_audit_order
-    df = read_mlfile('credit_audit_order', credit_audit_order_features, 'order_id', order_id, is_sql)
+    df = tables['credit_audit_order']
     df.rename(columns={'state': 'state_cao', 'remark': 'remark_cao'}, inplace=True)
     all_data_df = pd.merge(all_data_df, df, on='order_id', how='left')
 
@@ -433,13 +833,78 @@ def get_order_data(order_id=88668, is_sql=False):
     for feature in features:
         # print(all_data_df[feature].value_counts())
         all_data_df[feature] = all_data_df[feature].astype(str)
-        all_data_df[feature].fillna('0', inplace=True)
+        all_data_df[feature] = all_data_df[feature].fillna('0')
         all_data_df[feature] = np.where(all_data_df[feature].str.contains('1'), 1, 0)
         # print(all_data_df[feature].value_counts())
 
     return all_data_df
 
 
+# 可能晚于订单写入数据库的上游数据: 特征 -> (表名, risk_order中的type)
+late_input_features = {
+    'tongdun_result': ('risk_order', 'tongdun'),
+    'guanzhu_result': ('risk_order', 'guanzhu'),
+    'bai_qi_shi_result': ('risk_order', 'bai_qi_shi'),
+    'baiqishi_score': ('risk_order', 'bai_qi_shi'),
+    'final_score': ('tongdun', None),
+    'final_decision': ('tongdun', None),
+    'face_live_check': ('face_id_liveness', None),
+}
+
+
+def get_late_inputs(features):
+    '''特征列表依赖的上游数据，按出现顺序去重'''
+    return list(dict.fromkeys(late_input_features[f] for f in features if f in late_input_features))
+
+
+def get_missing_inputs(order_id, inputs):
+    '''一条语句查询上游数据是否已写入数据库，返回缺失的数据名称列表'''
+    if len(inputs) == 0:
+        return []
+    tables = tuple(dict.fromkeys(table for table, _ in inputs))
+    key = ('ready_check', tables)
+    statement = statement_cache.get(key)
+    if statement is None:
+        table_sqls = {
+            'risk_order': "SELECT 'risk_order' AS tbl, type FROM risk_order WHERE order_id = :order_id",
+            'tongdun': "SELECT 'tongdun' AS tbl, NULL AS type FROM tongdun WHERE order_number = "
+                       "(SELECT order_number FROM `order` WHERE id = :order_id)",
+            'face_id_liveness': "SELECT 'face_id_liveness' AS tbl, NULL AS type FROM face_id_liveness "
+                                "WHERE order_id = :order_id",
+        }
+        statement = statement_cache[key] = text(" UNION ALL ".join(table_sqls[table] for table in tables))
+    # 只需要表名和风控类型, 不构造DataFrame
+    with metrics.timer('mibao_table_fetch_seconds', table='ready_check'):
+        rows = read_sql_rows(statement, {'order_id': sql_param(order_id)})
+    ready_tables = set(tbl for tbl, _ in rows)
+    risk_types = [str(risk_type) for tbl, risk_type in rows if tbl == 'risk_order']
+
+    missing = []
+    for table, risk_type in inputs:
+        if table not in ready_tables:
+            missing.append(table if risk_type is None else "{}.{}".format(table, risk_type))
+        elif risk_type is not None and not any(x.startswith(risk_type) for x in risk_types):
+            missing.append("{}.{}".format(table, risk_type))
+    return missing
+
+
+def wait_order_data_ready(order_id, features=mibao_ml_features, timeout=3.0, interval=0.05, max_interval=0.5):
+    '''等待特征依赖的上游数据写入数据库，数据齐全立即返回
+
+    查询间隔从interval开始每次加倍, 最长max_interval, 超过timeout秒后不再等待。
+    返回仍缺失的数据名称列表，全部就绪时为空列表。
+    '''
+    inputs = get_late_inputs(features)
+    deadline = time.time() + timeout
+    while True:
+        missing = get_missing_inputs(order_id, inputs)
+        remaining = deadline - time.time()
+        if len(missing) == 0 or remaining <= 0:
+            return missing
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
+
 if __name__ == '__main__':
     # sql_tables = ['risk_white_list']
     save_all_tables_mibao()
@@ -7,60 +7,208 @@
 from sshtunnel import SSHTunnelForwarder
 import pandas as pd
 import os
+import atexit
+import socket
+import threading
 # import mlutils
 import json
+import pymysql
 from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from pymysql.constants import CLIENT
 from mibao_log import log
 from mltools import *
 from sql import *
-global sql_engine
-
-def sql_connect(sql_file, ssh_pkey=None):
-    '''连接数据库'''
-    with open(sql_file, encoding='utf-8') as f:
-        sql_info = json.load(f)
-
-    ssh_host = sql_info['ssh_host']
-    ssh_user = sql_info['ssh_user']
-    sql_address = sql_info['sql_address']
-    sql_user = sql_info['sql_user']
-    sql_password = sql_info['sql_password']
-    if ssh_pkey == None:
-        sql_engine = create_engine(
-            'mysql+pymysql://{}:{}@{}:3306/mibao_rds'.format(sql_user, sql_password, sql_address))
-        log.debug("Access MySQL directly")
-    else:
-        server = SSHTunnelForwarder((ssh_host, 22),  # ssh的配置
-                                    ssh_username=ssh_user,
-                                    ssh_pkey=ssh_pkey,
-                                    remote_bind_address=(sql_address, 3306))
-        server.start()
-        sql_engine = create_engine(
-            'mysql+pymysql://{}:{}@127.0.0.1:{}/mibao_rds'.format(sql_user, sql_password, server.local_bind_port))
-        log.debug("Access MySQL with SSH tunnel forward")
-
-    return sql_engine
-    # pd.read_sql("SELECT * from `order` o where o.id = 88668", sql_engine)
+
+# 连接池配置: pool_pre_ping取出连接时先检查连接是否可用, pool_recycle秒后重建连接(需小于MySQL的wait_timeout)
+sql_pool_options = {'pool_size': 10, 'max_overflow': 10, 'pool_timeout': 10, 'pool_recycle': 3600,
+                    'pool_pre_ping': True}
+# 需要重建连接的MySQL客户端错误: 无法连接服务器, 连接已断开, 查询中连接丢失
+connection_error_codes = {2003, 2006, 2013, 2055}
+
+
+def is_connection_error(e):
+    '''异常是否由数据库连接断开引起, SQL语句错误等其它异常不需要重连'''
+    if isinstance(e, DBAPIError):
+        if e.connection_invalidated:
+            return True
+        e = e.orig
+    if isinstance(e, pymysql.err.InterfaceError):
+        return True
+    if isinstance(e, pymysql.err.OperationalError):
+        return len(e.args) > 0 and e.args[0] in connection_error_codes
+    return isinstance(e, (ConnectionError, socket.timeout))
+
+
+class SqlConnection(object):
+    '''进程内共用的数据库连接
+
+    整个进程只有一个SSH隧道和一个带连接池的engine; 一次执行多条语句的read_sql_queries另用一个
+    允许多语句的engine, 其它查询不能执行拼接的多条语句。隧道断开时重启原来的隧道,
+    只有连接错误才重建连接池并重试一次, 其它错误直接抛出。
+    url不为None时直接连接url, 用于本地测试数据库。
+    '''
+
+    def __init__(self, sql_file=None, ssh_pkey=None, url=None, pool_options=None):
+        self.sql_file = sql_file
+        self.ssh_pkey = ssh_pkey
+        self.url = url
+        self.pool_options = dict(sql_pool_options if pool_options is None else pool_options)
+        self.tunnel = None
+        # multi_statements -> engine
+        self._engines = {}
+        self.lock = threading.Lock()
+        self.reconnects = 0
+        self.tunnel_restarts = 0
+
+    @property
+    def engine(self):
+        return self.get_engine()
+
+    def get_engine(self, multi_statements=False):
+        engine = self._engines.get(multi_statements)
+        if engine is None:
+            with self.lock:
+                if multi_statements not in self._engines:
+                    self._engines[multi_statements] = self._create_engine(multi_statements)
+                engine = self._engines[multi_statements]
+        return engine
+
+    def _start_tunnel(self, sql_info):
+        '''启动或重启SSH隧道, 返回本地端口'''
+        if self.tunnel is None:
+            self.tunnel = SSHTunnelForwarder((sql_info['ssh_host'], 22),  # ssh的配置
+                                             ssh_username=sql_info['ssh_user'],
+                                             ssh_pkey=self.ssh_pkey,
+                                             remote_bind_address=(sql_info['sql_address'], 3306),
+                                             set_keepalive=30)
+            self.tunnel.start()
+            log.debug("Access MySQL with SSH tunnel forward")
+        elif not self.tunnel.is_active:
+            self.tunnel.restart()
+            self.tunnel_restarts += 1
+            log.warning("SSH tunnel restarted")
+        return self.tunnel.local_bind_port
+
+    def _create_engine(self, multi_statements=False):
+        if self.url is not None:
+            return create_engine(self.url, **self.pool_options)
+
+        with open(self.sql_file, encoding='utf-8') as f:
+            sql_info = json.load(f)
+        if self.ssh_pkey is None:
+            address = '{}:3306'.format(sql_info['sql_address'])
+            log.debug("Access MySQL directly")
+        else:
+            address = '127.0.0.1:{}'.format(self._start_tunnel(sql_info))
+        # multi_statements时允许一次执行多条语句，供read_sql_queries一次往返读取多个结果集
+        connect_args = {'client_flag': CLIENT.MULTI_STATEMENTS} if multi_statements else {}
+        return create_engine(
+            'mysql+pymysql://{}:{}@{}/mibao_rds'.format(sql_info['sql_user'], sql_info['sql_password'], address),
+            connect_args=connect_args, **self.pool_options)
+
+    def reconnect(self, engine):
+        '''丢弃出错的engine的连接池并重新连接, 多个线程同时出错时只重建一次'''
+        with self.lock:
+            for multi_statements, current in self._engines.items():
+                if current is engine:
+                    engine.dispose()
+                    self._engines[multi_statements] = self._create_engine(multi_statements)
+                    self.reconnects += 1
+                    return
+
+    def execute(self, func, multi_statements=False):
+        '''调用func(engine), 出现连接错误时重新连接后再调用一次; multi_statements时使用允许多语句的engine'''
+        engine = self.get_engine(multi_statements)
+        try:
+            return func(engine)
+        except Exception as e:
+            if not is_connection_error(e):
+                raise
+            log.warning("database connection error, reconnecting: {}".format(e))
+            self.reconnect(engine)
+            return func(self.get_engine(multi_statements))
+
+    def pool_stats(self):
+        pool = self.engine.pool
+        stats = {'reconnects': self.reconnects, 'tunnel_restarts': self.tunnel_restarts}
+        for name in ['size', 'checkedin', 'checkedout', 'overflow']:
+            if hasattr(pool, name):
+                stats[name] = getattr(pool, name)()
+        if self.tunnel is not None:
+            stats['tunnel_active'] = int(self.tunnel.is_active)
+        return stats
+
+    def after_fork(self):
+        '''fork出的子进程不能使用父进程的连接, 丢弃连接池但不关闭父进程的连接
+
+        SSH隧道由父进程的线程转发, 子进程继续连接同一个本地端口
+        '''
+        self.lock = threading.Lock()
+        for engine in self._engines.values():
+            engine.dispose(close=False)
+
+    def close(self):
+        with self.lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines = {}
+            if self.tunnel is not None:
+                self.tunnel.stop()
+                self.tunnel = None
+
 
 # 初始化数据库连接，使用pymysql模块
+sql_connection = SqlConnection(os.path.join(workdir, 'sql_mibao.json'),
+                               os.path.join(workdir, 'sql_pkey') if debug_mode else None)
+atexit.register(sql_connection.close)
+
+
 def get_sql_engine():
-    sql_file = os.path.join(workdir, 'sql_mibao.json')
-    ssh_pkey = os.path.join(workdir, 'sql_pkey') if debug_mode else None
-    sql_engine = sql_connect(sql_file, ssh_pkey)
+    return sql_connection.engine
 
-    return sql_engine
 
-sql_engine = get_sql_engine()
+def read_sql_query(sql, params=None):
+    '''sql可以是带:name参数的text语句, params为参数字典'''
+    return sql_connection.execute(lambda engine: pd.read_sql_query(sql, engine, params=params))
 
-def read_sql_query(sql):
-    global sql_engine
 
+def _read_sql_rows(sql, params, engine):
+    with engine.connect() as conn:
+        return [tuple(row) for row in conn.execute(sql, params or {})]
+
+
+def read_sql_rows(sql, params=None):
+    '''执行text查询语句，返回元组列表，只需要少量数值时不必构造DataFrame'''
+    return sql_connection.execute(lambda engine: _read_sql_rows(sql, params, engine))
+
+
+def _read_sql_queries(sqls, params, engine):
+    conn = engine.raw_connection()
     try:
-        df = pd.read_sql_query(sql, sql_engine)
-    except:
-        sql_engine = get_sql_engine()
-        df = pd.read_sql_query(sql, sql_engine)
+        cursor = conn.cursor()
+        cursor.execute("".join(sqls), params)
+        results = []
+        while True:
+            results.append(([col[0] for col in cursor.description], list(cursor.fetchall())))
+            if not cursor.nextset():
+                break
+        cursor.close()
+    finally:
+        conn.close()
+    return results
+
+
+def read_sql_queries_rows(sqls, params=None):
+    '''与read_sql_queries相同, 每条语句返回(字段名列表, 元组列表), 供调用方自行拆分结果'''
+    return sql_connection.execute(lambda engine: _read_sql_queries(sqls, params, engine), multi_statements=True)
 
-    return df
 
+def read_sql_queries(sqls, params=None):
+    '''一次数据库往返执行多条以;结尾的查询语句，按顺序返回每条语句的DataFrame
 
+    params为参数字典, 语句中用%(name)s引用参数, 此时语句中的%需写成%%
+    '''
+    # 与pd.read_sql_query相同的方式构造DataFrame，保证数据类型一致
+    return [pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+            for columns, rows in read_sql_queries_rows(sqls, params)]